@@ -10,8 +10,99 @@ TABLE_NAME = os.getenv("FATURAMENTO_TABLE", "faturamento")
 # Config de LLM
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 USE_LLM = bool(OPENAI_API_KEY)
+# Planejamento (gera SQL) precisa do modelo melhor; a resposta só resume linhas prontas
+QUERIES_MODEL = os.getenv("QUERIES_MODEL", "gpt-4o-mini")
+ANSWER_MODEL = os.getenv("ANSWER_MODEL", "gpt-4.1-nano")
+# Verificador da zona cinza do cache semântico ("mesma intenção?": sim/não)
+VERIFIER_MODEL = os.getenv("VERIFIER_MODEL", "gpt-4o-mini")
+# Teto de tokens do plano (até 5 SQLs curtas): corta gerações que desandam
+QUERIES_MAX_TOKENS = int(os.getenv("QUERIES_MAX_TOKENS", "1024"))
+# Cliente HTTP do OpenAI: conexões persistentes (HTTP/2) compartilhadas entre requisições
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "30"))  # segundos
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "100"))
+# Retentativas do SDK (backoff exponencial com jitter em timeout, 429 e 5xx)
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
 
 # Limites
-MAX_ROWS = 10000
+MAX_ROWS = int(os.getenv("MAX_ROWS", "10000"))
+# LIMIT injetado em listagens (SELECT sem agregação) que vierem sem LIMIT
+MAX_LIST_ROWS = int(os.getenv("MAX_LIST_ROWS", "1000"))
 MAX_COLS = 30
-MAX_ROWS_FOR_LLM = MAX_ROWS
+# Linhas enviadas ao LLM por pergunta (além disso o resultado é marcado como
+# "truncated"); com várias queries, cada uma fica com uma parte, no mínimo
+# MIN_ROWS_PER_QUERY (totais/agrupamentos pequenos passam inteiros)
+MAX_ROWS_FOR_LLM = int(os.getenv("MAX_ROWS_FOR_LLM", "200"))
+MIN_ROWS_PER_QUERY = int(os.getenv("MIN_ROWS_PER_QUERY", "20"))
+# Tamanho máximo (aprox., em caracteres de JSON) das linhas de todas as queries
+# no prompt da resposta; dividido igualmente entre as queries da pergunta.
+# Mais linhas = resposta mais completa, mas prompt maior e mais lento.
+ROW_MARSHAL_BUDGET_BYTES = int(os.getenv("ROW_MARSHAL_BUDGET_BYTES", "40000"))
+
+# Execução das subconsultas (1 a 5 por pergunta) e pool de conexões
+# Orçamento de conexões do container inteiro: cada worker do uvicorn tem o
+# próprio pool e mais uma conexão de LISTEN. O Postgres aceita 100 por padrão
+# (max_connections) e o ETL usa ETL_WORKERS + 1; o orçamento tem que caber nisso.
+DB_CONNECTION_BUDGET = int(os.getenv("DB_CONNECTION_BUDGET", "60"))
+UVICORN_WORKERS = int(os.getenv("UVICORN_WORKERS", "1"))
+_WORKER_CONNECTIONS = max(DB_CONNECTION_BUDGET // UVICORN_WORKERS - 1, 2)  # -1: LISTEN
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))  # conexões abertas já no startup
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", str(max(_WORKER_CONNECTIONS * 2 // 3, 1))))
+DB_MAX_OVERFLOW = int(
+    os.getenv("DB_MAX_OVERFLOW", str(max(_WORKER_CONNECTIONS - DB_POOL_SIZE, 0)))
+)
+# Threads compartilhadas por todas as requisições; mais que o pool de conexões só geraria espera
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", str(DB_POOL_SIZE + DB_MAX_OVERFLOW)))
+# Recicla conexões antigas antes que NAT/LB as derrubem em silêncio
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # segundos
+STATEMENT_TIMEOUT_MS = int(os.getenv("STATEMENT_TIMEOUT_MS", "15000"))
+DB_PREPARE_THRESHOLD = int(os.getenv("DB_PREPARE_THRESHOLD", "2"))
+
+# Threads do FastAPI para os handlers síncronos (padrão do anyio é 40)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "100"))
+
+# Cache de resultados por SQL (curto: os dados mudam a cada carga do ETL)
+QUERY_RESULT_CACHE_TTL = int(os.getenv("QUERY_RESULT_CACHE_TTL", "60"))  # segundos
+QUERY_RESULT_CACHE_MAXSIZE = int(os.getenv("QUERY_RESULT_CACHE_MAXSIZE", "512"))
+
+# Cache do esquema da tabela (information_schema)
+SCHEMA_CACHE_TTL = int(os.getenv("SCHEMA_CACHE_TTL", "600"))  # segundos
+# Valores distintos de exemplo por coluna de texto, mostrados ao LLM junto do esquema
+SCHEMA_SAMPLE_VALUES = int(os.getenv("SCHEMA_SAMPLE_VALUES", "5"))
+
+# Cache de respostas do LLM (em memória, por processo)
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "1800"))  # segundos
+LLM_CACHE_MAXSIZE = int(os.getenv("LLM_CACHE_MAXSIZE", "1024"))
+
+# Cache semântico (embeddings das perguntas)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+SEMANTIC_CACHE_MAXSIZE = int(os.getenv("SEMANTIC_CACHE_MAXSIZE", "2048"))
+SEMANTIC_CACHE_HIT = float(os.getenv("SEMANTIC_CACHE_HIT", "0.95"))
+SEMANTIC_CACHE_GRAY = float(os.getenv("SEMANTIC_CACHE_GRAY", "0.88"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+
+# Cache semântico da resposta completa do /run-agent (pula LLM e banco)
+RESPONSE_CACHE_HIT = float(os.getenv("RESPONSE_CACHE_HIT", "0.92"))
+RESPONSE_CACHE_GRAY = float(os.getenv("RESPONSE_CACHE_GRAY", "0.85"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # períodos fechados
+RESPONSE_CACHE_TTL_OPEN = int(os.getenv("RESPONSE_CACHE_TTL_OPEN", "3600"))  # "este mês", "hoje"...
+
+# Limiar de hit do cache de respostas adaptativo: a cada RESPONSE_CACHE_ADAPT_WINDOW
+# buscas ele desce se a taxa de hits fica abaixo do alvo e sobe se o verificador
+# da zona cinza rejeita candidatos demais. O mínimo fica acima de RESPONSE_CACHE_GRAY
+# para a zona cinza (e o verificador) nunca sumir.
+RESPONSE_CACHE_ADAPTIVE = os.getenv("RESPONSE_CACHE_ADAPTIVE", "1") == "1"
+RESPONSE_CACHE_HIT_MIN = float(os.getenv("RESPONSE_CACHE_HIT_MIN", "0.88"))
+RESPONSE_CACHE_HIT_MAX = float(os.getenv("RESPONSE_CACHE_HIT_MAX", "0.98"))
+RESPONSE_CACHE_TARGET_HIT_RATE = float(os.getenv("RESPONSE_CACHE_TARGET_HIT_RATE", "0.5"))
+RESPONSE_CACHE_ADAPT_WINDOW = int(os.getenv("RESPONSE_CACHE_ADAPT_WINDOW", "1000"))
+
+# Cache exato da resposta completa, consultado antes do semântico.
+# Com REDIS_URL é compartilhado entre workers/réplicas; sem ele, fica em memória.
+REDIS_URL = os.getenv("REDIS_URL", "")
+RESPONSE_CACHE_MAXSIZE = int(os.getenv("RESPONSE_CACHE_MAXSIZE", "4096"))
+
+# Camada de métricas pré-calculadas (totais de faturamento sem LLM)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DATE_COLUMN = os.getenv("METRICS_DATE_COLUMN", "data_emissao")
+METRICS_REFRESH_INTERVAL = int(os.getenv("METRICS_REFRESH_INTERVAL", "300"))  # segundos
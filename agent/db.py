@@ -1,30 +1,257 @@
-from typing import List, Dict
+import threading
+import time
+from collections import defaultdict
+from functools import lru_cache
+from typing import Callable, List, Dict, Sequence, Tuple
 
-from sqlalchemy import create_engine, text
+import orjson
+import psycopg
 
-from config import DATABASE_URL, TABLE_NAME
+from cachetools.func import ttl_cache
+from sqlalchemy import TextClause, create_engine, make_url, text
+
+from config import (
+    DATABASE_URL,
+    TABLE_NAME,
+    SCHEMA_CACHE_TTL,
+    SCHEMA_SAMPLE_VALUES,
+    DB_POOL_MIN,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_RECYCLE,
+    STATEMENT_TIMEOUT_MS,
+    DB_PREPARE_THRESHOLD,
+)
 from models import Row
 
+# Driver psycopg 3 (binário): decodificação de linhas em C, mais rápida que o psycopg2.
+# Aceita DATABASE_URL no formato postgresql:// e só troca o driver.
+ENGINE_URL = make_url(DATABASE_URL).set(drivername="postgresql+psycopg")
+
 # Engine global
-engine = create_engine(DATABASE_URL)
+# (pool dimensionado para as subconsultas rodarem em paralelo)
+engine = create_engine(
+    ENGINE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=DB_POOL_RECYCLE,
+    # json/jsonb lidos do banco (ex.: query_templates.queries) passam pelo orjson
+    json_deserializer=orjson.loads,
+    connect_args={
+        # Somente leitura por padrão: mesmo o que escapar do filtro de SQL não
+        # escreve. A única escrita do agente (query_templates) pede READ WRITE.
+        "options": f"-c statement_timeout={STATEMENT_TIMEOUT_MS} -c default_transaction_read_only=on",
+        # psycopg 3 prepara no servidor (PREPARE) a SQL repetida na mesma conexão
+        # a partir da N-ésima execução; as próximas pulam parse + plan.
+        "prepare_threshold": DB_PREPARE_THRESHOLD,
+    },
+)
+
+# Leituras puras: AUTOCOMMIT dispensa o BEGIN/COMMIT a cada SELECT
+read_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+
+
+def warm_pool(n: int = DB_POOL_MIN) -> None:
+    """
+    Abre n conexões do pool de uma vez e as devolve, para a primeira rajada
+    de perguntas não pagar o handshake com o Postgres.
+    """
+    conns = []
+    try:
+        for _ in range(min(n, DB_POOL_SIZE)):
+            conns.append(engine.connect())
+    finally:
+        for conn in conns:
+            conn.close()
+
+
+# Canal em que o ETL avisa (pg_notify) que criou colunas novas
+SCHEMA_CHANNEL = "schema_changed"
+# Canal em que o ETL avisa que carregou linhas (no COMMIT da carga)
+DATA_CHANNEL = "data_changed"
+
+
+# SQLs fixas montadas uma vez só (text() a cada chamada refaz o parse dos binds)
 
+# pg_attribute direto: information_schema.columns é uma view pesada
+# (vários joins e funções auxiliares) para uma tabela só.
+# Colunas de várias tabelas num só round-trip (tabela inexistente não traz linhas)
+_SCHEMA_SQL = text(
+    """
+    SELECT t.name, a.attname, format_type(a.atttypid, a.atttypmod)
+    FROM unnest(CAST(:tables AS text[])) AS t(name)
+    JOIN pg_attribute a ON a.attrelid = to_regclass(t.name)
+    WHERE a.attnum > 0
+      AND NOT a.attisdropped
+    ORDER BY t.name, a.attnum
+    """
+)
 
+_READ_WRITE_SQL = text("SET TRANSACTION READ WRITE")
+
+_SAVE_TEMPLATE_SQL = text(
+    """
+    INSERT INTO query_templates (schema_fingerprint, question, embedding, queries)
+    VALUES (:fingerprint, :question, :embedding, CAST(:queries AS jsonb))
+    ON CONFLICT (schema_fingerprint, question)
+    DO UPDATE SET embedding = EXCLUDED.embedding, queries = EXCLUDED.queries, created_at = NOW()
+    """
+)
+
+_LOAD_TEMPLATES_SQL = text(
+    """
+    SELECT question, embedding, queries
+    FROM (
+        SELECT question, embedding, queries, created_at
+        FROM query_templates
+        WHERE schema_fingerprint = :fingerprint
+        ORDER BY created_at DESC
+        LIMIT :limit
+    ) t
+    ORDER BY created_at
+    """
+)
+
+
+# Esquema muda só quando o ETL cria colunas; o TTL é a rede de segurança
+# e o LISTEN em SCHEMA_CHANNEL invalida na hora (ver listen_schema_changes).
+@ttl_cache(maxsize=32, ttl=SCHEMA_CACHE_TTL)
 def get_table_schema(table_name: str = TABLE_NAME) -> List[Dict[str, str]]:
-    sql = text(
-        """
-        SELECT column_name, data_type
-        FROM information_schema.columns
-        WHERE table_name = :table
-        ORDER BY ordinal_position
+    return get_table_schemas([table_name]).get(table_name, [])
+
+
+def get_table_schemas(table_names: Sequence[str]) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Esquema de várias tabelas com uma única consulta ao catálogo, agrupado
+    por tabela (na ordem das colunas). Tabelas que não existem ficam de fora.
+    """
+    schemas: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+    with read_engine.connect() as conn:
+        for table, name, type_ in conn.execute(_SCHEMA_SQL, {"tables": list(table_names)}):
+            schemas[table].append({"name": name, "type": type_})
+    return dict(schemas)
+
+
+# Colunas de texto que não vale amostrar (metadados do ETL)
+_SAMPLE_SKIP_COLS = {"arquivo_nome"}
+
+
+@ttl_cache(maxsize=32, ttl=SCHEMA_CACHE_TTL)
+def get_column_samples(table_name: str = TABLE_NAME) -> Dict[str, List[str]]:
+    """
+    Alguns valores distintos de cada coluna de texto (ex.: status), para o LLM
+    escrever filtros com os valores reais. Cacheado e invalidado junto do esquema;
+    todas as colunas saem numa única consulta (UNION ALL), um só round-trip.
+    ORDER BY: os mesmos valores a cada recarga, senão o prompt de sistema muda
+    (e perde o prompt cache do LLM) sem o esquema ter mudado.
+    """
+    text_cols = [
+        c["name"] for c in get_table_schema(table_name)
+        if (c["type"] == "text" or c["type"].startswith("character varying"))
+        and c["name"] not in _SAMPLE_SKIP_COLS
+    ]
+    if not text_cols:
+        return {}
+
+    parts = [
+        f'SELECT :c{i} AS c, v::text AS v FROM ('
+        f'SELECT DISTINCT "{col}" AS v FROM {table_name} WHERE "{col}" IS NOT NULL ORDER BY v LIMIT :n'
+        f') s{i}'
+        for i, col in enumerate(text_cols)
+    ]
+    params = {f"c{i}": col for i, col in enumerate(text_cols)}
+    params["n"] = SCHEMA_SAMPLE_VALUES
+
+    samples: Dict[str, List[str]] = {}
+    with read_engine.connect() as conn:
+        for col, value in conn.execute(text(" UNION ALL ".join(parts)), params):
+            samples.setdefault(col, []).append(value)
+    return samples
+
+
+def db_mcp_tool(sql: str | TextClause) -> List[Row]:
+    with read_engine.connect() as conn:
+        result = conn.execute(text(sql) if isinstance(sql, str) else sql)
+        # RowMapping já se comporta como dict para leitura: sem copiar cada linha
+        return result.mappings().all()
+
+
+def db_json_tool(sql: str, max_rows: int) -> Tuple[int, bool, str]:
+    """
+    Executa a SELECT embrulhada num json_agg: o Postgres devolve numa única
+    linha o array JSON (já serializado) das primeiras max_rows, sem criar um
+    dict Python por linha. A leitura para em max_rows + 1: a linha extra só
+    indica que o resultado foi cortado, sem percorrer o resto. Chaves com
+    valor nulo saem de cada linha (json_strip_nulls): só gastariam tokens.
+    Devolve (linhas devolvidas, cortado?, rows_json).
+    """
+    with read_engine.connect() as conn:
+        n, rows_json = conn.execute(_json_wrapped(sql), {"max_rows": max_rows}).one()
+    return min(n, max_rows), n > max_rows, rows_json
+
+
+# A mesma SQL volta sempre com o mesmo texto embrulhado: o TextClause é
+# montado (e os binds extraídos) uma vez, e o texto idêntico é o que deixa
+# o psycopg reaproveitar o PREPARE e o SQLAlchemy o statement compilado.
+@lru_cache(maxsize=512)
+def _json_wrapped(sql: str) -> TextClause:
+    return text(
+        f"""
+        SELECT
+            COUNT(*) AS n,
+            COALESCE(
+                json_agg(json_strip_nulls(to_json(s.r)) ORDER BY s.rn) FILTER (WHERE s.rn <= :max_rows),
+                '[]'::json
+            )::text AS rows_json
+        FROM (
+            SELECT row_number() OVER () AS rn, x AS r
+            FROM ({sql}) x
+            LIMIT :max_rows + 1
+        ) s
         """
     )
-    with engine.begin() as conn:
-        result = conn.execute(sql, {"table": table_name})
-        return [{"name": row[0], "type": row[1]} for row in result.fetchall()]
 
 
-def db_mcp_tool(sql: str) -> List[Row]:
+def save_query_template(fingerprint: str, question: str, embedding: bytes, queries_json: str) -> None:
     with engine.begin() as conn:
-        result = conn.execute(text(sql))
-        rows = result.mappings().all()
-    return [dict(r) for r in rows]
+        conn.execute(_READ_WRITE_SQL)
+        conn.execute(_SAVE_TEMPLATE_SQL, {
+            "fingerprint": fingerprint,
+            "question": question,
+            "embedding": embedding,
+            "queries": queries_json,
+        })
+
+
+def load_query_templates(fingerprint: str, limit: int) -> List[Row]:
+    """Planos gravados para o esquema, do mais antigo ao mais recente."""
+    with read_engine.connect() as conn:
+        return conn.execute(_LOAD_TEMPLATES_SQL, {"fingerprint": fingerprint, "limit": limit}).mappings().all()
+
+
+def _listen_loop(handlers: Dict[str, Callable[[str], None]]) -> None:
+    conninfo = make_url(DATABASE_URL).set(drivername="postgresql").render_as_string(hide_password=False)
+    while True:
+        try:
+            with psycopg.connect(conninfo, autocommit=True) as conn:
+                for channel in handlers:
+                    conn.execute(f"LISTEN {channel}")
+                for notify in conn.notifies():
+                    handlers[notify.channel](notify.payload)
+        except Exception as e:
+            print(f"[AGENT] LISTEN {', '.join(handlers)} caiu, reconectando: {e}")
+            time.sleep(5)
+
+
+def listen_schema_changes(
+    on_change: Callable[[str], None], on_data_change: Callable[[str], None]
+) -> None:
+    """
+    Escuta os canais do ETL numa thread própria (uma conexão só): chama
+    on_change(tabela) a cada ALTER TABLE (SCHEMA_CHANNEL) e
+    on_data_change(tabela) a cada arquivo carregado (DATA_CHANNEL).
+    """
+    handlers = {SCHEMA_CHANNEL: on_change, DATA_CHANNEL: on_data_change}
+    thread = threading.Thread(target=_listen_loop, args=(handlers,), name="schema-listener", daemon=True)
+    thread.start()
@@ -1,25 +1,179 @@
+import hashlib
 import json
-from typing import Dict, Any, List
-
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from functools import lru_cache
+from typing import Callable, Dict, Any, Iterator, List, Tuple
+
+import numpy as np
+import orjson
+from cachetools import TTLCache
+from cachetools.func import ttl_cache
 from fastapi import HTTPException
 
-from config import TABLE_NAME, MAX_ROWS_FOR_LLM, USE_LLM, OPENAI_API_KEY
-from db import get_table_schema
+from config import (
+    TABLE_NAME,
+    THREADPOOL_SIZE,
+    USE_LLM,
+    OPENAI_API_KEY,
+    QUERIES_MODEL,
+    QUERIES_MAX_TOKENS,
+    ANSWER_MODEL,
+    VERIFIER_MODEL,
+    ROW_MARSHAL_BUDGET_BYTES,
+    MAX_ROWS_FOR_LLM,
+    MIN_ROWS_PER_QUERY,
+    OPENAI_TIMEOUT,
+    OPENAI_CONNECT_TIMEOUT,
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_RETRIES,
+    SCHEMA_CACHE_TTL,
+    LLM_CACHE_TTL,
+    LLM_CACHE_MAXSIZE,
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_MAXSIZE,
+    SEMANTIC_CACHE_HIT,
+    SEMANTIC_CACHE_GRAY,
+    EMBEDDING_MODEL,
+    RESPONSE_CACHE_HIT,
+    RESPONSE_CACHE_GRAY,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_TTL_OPEN,
+    RESPONSE_CACHE_ADAPTIVE,
+    RESPONSE_CACHE_HIT_MIN,
+    RESPONSE_CACHE_HIT_MAX,
+    RESPONSE_CACHE_TARGET_HIT_RATE,
+    RESPONSE_CACHE_ADAPT_WINDOW,
+)
+from db import get_table_schema, get_column_samples, load_query_templates, save_query_template
+from semcache import SemanticCache
+from utils import run_queries
+from singleflight import SingleFlight
+import respcache
 
 if USE_LLM:
+    import httpx
     from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
-
-
-def llm_generate_queries(question: str) -> List[Dict[str, Any]]:
-    if not USE_LLM:
-        raise RuntimeError("LLM não configurado (OPENAI_API_KEY ausente).")
-
-    schema = get_table_schema(TABLE_NAME)
-    schema_lines = [f"- {c['name']} ({c['type']})" for c in schema]
-    schema_desc = "\n".join(schema_lines) if schema_lines else "(sem colunas)"
 
-    system_prompt = """
+    # Um único pool HTTP/2 para todas as chamadas (queries, resposta, embeddings):
+    # reaproveita a sessão TLS em vez de reabrir conexão a cada pergunta.
+    _http = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_CONNECTIONS // 2,
+        ),
+        timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT),
+    )
+    client = OpenAI(api_key=OPENAI_API_KEY, http_client=_http, max_retries=OPENAI_MAX_RETRIES)
+
+# Caches das chamadas ao LLM (temperature=0 -> mesma entrada, mesma saída)
+_queries_cache: TTLCache = TTLCache(maxsize=LLM_CACHE_MAXSIZE, ttl=LLM_CACHE_TTL)
+_cache_lock = threading.Lock()
+
+# Cache semântico: pega paráfrases que o cache exato não reconhece
+_semantic_queries = SemanticCache(SEMANTIC_CACHE_MAXSIZE, SEMANTIC_CACHE_HIT, SEMANTIC_CACHE_GRAY)
+_semantic_answers = SemanticCache(SEMANTIC_CACHE_MAXSIZE, SEMANTIC_CACHE_HIT, SEMANTIC_CACHE_GRAY)
+# O de respostas tem verificador na zona cinza: é ele que calibra o limiar adaptativo
+_semantic_responses = SemanticCache(
+    SEMANTIC_CACHE_MAXSIZE,
+    RESPONSE_CACHE_HIT,
+    RESPONSE_CACHE_GRAY,
+    threshold_range=(
+        (RESPONSE_CACHE_HIT_MIN, RESPONSE_CACHE_HIT_MAX) if RESPONSE_CACHE_ADAPTIVE else None
+    ),
+    target_hit_rate=RESPONSE_CACHE_TARGET_HIT_RATE,
+    window=RESPONSE_CACHE_ADAPT_WINDOW,
+)
+_embedding_cache: TTLCache = TTLCache(maxsize=LLM_CACHE_MAXSIZE, ttl=LLM_CACHE_TTL)
+
+# Misses simultâneos da mesma pergunta fazem uma única chamada ao LLM
+_queries_flight = SingleFlight()
+
+# Esquemas cujos planos gravados já foram carregados no cache semântico
+_loaded_template_scopes: set = set()
+
+# Pool para adiantar chamadas independentes (ex.: embedding x esquema). Está no
+# caminho de toda pergunta: um worker por thread de requisição, senão uma
+# rajada fica na fila do embedding.
+_prefetch_pool = ThreadPoolExecutor(max_workers=THREADPOOL_SIZE, thread_name_prefix="llm-prefetch")
+
+# Trabalho que não segura a resposta (gravar caches/planos): pool próprio,
+# para não disputar workers com os embeddings
+_background_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="llm-background")
+
+_NON_WORD_RE = re.compile(r"[^\w]+")
+
+# raw_decode (só no json da stdlib) lê um objeto a partir de uma posição do buffer
+_json_decoder = json.JSONDecoder()
+
+# SQL que ainda vier cercada por ```sql ... ``` dentro do campo "sql"
+_FENCE_RE = re.compile(r"^\s*```(?:sql)?\s*\n?(.*?)\n?```\s*$", re.S | re.I)
+
+# Perguntas sobre janelas ainda abertas (os dados mudam): TTL curto no cache de respostas
+_OPEN_WINDOW_RE = re.compile(
+    r"\b(?:hoje|ontem|agora|atual|atualmente|recentes?|"
+    r"(?:este|esse|neste|nesse) (?:m[eê]s|ano|trimestre)|(?:esta|essa|nesta|nessa) semana|"
+    r"[uú]ltim[oa]s?)\b"
+)
+
+
+# Uma mesma requisição normaliza a pergunta várias vezes (métricas, chaves de
+# cache, embedding); a cópia em minúsculas + regex é feita só na primeira.
+@lru_cache(maxsize=1024)
+def normalize_question(question: str) -> str:
+    """Normaliza a pergunta para compor chaves de cache (minúsculas, sem pontuação)."""
+    return _NON_WORD_RE.sub(" ", question.lower()).strip()
+
+
+# Último esquema visto -> fingerprint. get_table_schema devolve a mesma lista
+# enquanto o cache dele vale, e uma requisição pede o fingerprint várias vezes
+# (chaves de cache, cache semântico, templates): o dump + hash sai uma vez só.
+_last_fingerprint: Tuple[Any, str] = (None, "")
+
+
+def schema_fingerprint(schema: List[Dict[str, str]]) -> str:
+    """Hash curto do esquema; muda sempre que o ETL cria/altera colunas."""
+    global _last_fingerprint
+    last_schema, fingerprint = _last_fingerprint
+    if schema is last_schema:
+        return fingerprint
+    raw = orjson.dumps(schema, option=orjson.OPT_SORT_KEYS)
+    fingerprint = hashlib.blake2b(raw, digest_size=8).hexdigest()
+    _last_fingerprint = (schema, fingerprint)
+    return fingerprint
+
+
+def _json_default(obj: Any) -> Any:
+    # Decimal (SUM/AVG do Postgres) vira número; o resto cai para str como antes
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return str(obj)
+
+
+def to_json(obj: Any) -> str:
+    """Serializa com orjson (datetime/date nativos, UTF-8, sem callback por valor)."""
+    return orjson.dumps(
+        obj,
+        default=_json_default,
+        option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+    ).decode()
+
+
+def _cache_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+
+# Prompts montados com a parte fixa primeiro e a variável no fim, para
+# aproveitar o prompt caching automático da OpenAI (cache por prefixo).
+# O cache é por modelo: planejamento (e correção, QUERIES_MODEL) e resposta
+# (ANSWER_MODEL) são conversas separadas, cada uma com a própria chave.
+PROMPT_CACHE_KEY = f"webox::{TABLE_NAME}"
+ANSWER_PROMPT_CACHE_KEY = f"webox::{TABLE_NAME}::answer"
+
+QUERIES_SYSTEM_PROMPT = """
 Você é um assistente que planeja análises de faturamento E gera SQL para PostgreSQL.
 
 TAREFA:
@@ -42,9 +196,43 @@ REGRAS:
    - faturamento_bruto_total
    - faturamento_liquido_total
    NÃO dependa de somar várias linhas fora do banco.
-9) Responda SEMPRE com JSON válido, sem markdown.
-
-FORMATO OBRIGATÓRIO:
+9) Envie as consultas SEMPRE chamando a ferramenta run_queries (sem markdown).
+10) Em filtros (WHERE), compare a coluna "crua" para aproveitar índices:
+    - datas por intervalo: data_emissao >= DATE '2024-01-01' AND data_emissao < DATE '2025-01-01'
+      (NÃO use EXTRACT/DATE_TRUNC/TO_CHAR sobre a coluna no WHERE; use-os só no SELECT/GROUP BY);
+    - igualdade direta: cliente_id = 'x' (sem LOWER/CAST na coluna quando não for necessário).
+11) Consultas que listam linhas (sem agregação) devem ter ORDER BY e LIMIT 100,
+    a menos que o usuário peça explicitamente a lista completa.
+12) Arredonde médias, divisões e percentuais com ROUND(expr::numeric, 2), e
+    selecione só as colunas que a resposta vai usar (cada coluna vira tokens).
+
+EXEMPLOS DE REFERÊNCIA (adapte à tabela e use só colunas que existam no esquema):
+- Pergunta: "Qual foi o faturamento total de 2024?"
+  SQL: SELECT SUM(valor_bruto) AS faturamento_bruto_total,
+              SUM(valor_liquido) AS faturamento_liquido_total
+       FROM faturamento
+       WHERE data_emissao >= DATE '2024-01-01' AND data_emissao < DATE '2025-01-01'
+- Pergunta: "Como foi o faturamento mês a mês em 2024?"
+  SQL: SELECT DATE_TRUNC('month', data_emissao)::date AS mes,
+              SUM(valor_bruto) AS faturamento_bruto,
+              SUM(valor_liquido) AS faturamento_liquido
+       FROM faturamento
+       WHERE data_emissao >= DATE '2024-01-01' AND data_emissao < DATE '2025-01-01'
+       GROUP BY 1
+       ORDER BY 1
+- Pergunta: "Quais os 10 clientes que mais faturaram?"
+  SQL: SELECT cliente_id, SUM(valor_bruto) AS faturamento_bruto_total
+       FROM faturamento
+       GROUP BY cliente_id
+       ORDER BY faturamento_bruto_total DESC
+       LIMIT 10
+- Pergunta: "Quantas notas foram emitidas por status?"
+  SQL: SELECT status, COUNT(*) AS quantidade_notas
+       FROM faturamento
+       GROUP BY status
+       ORDER BY quantidade_notas DESC
+
+FORMATO OBRIGATÓRIO (argumentos de run_queries):
 {
   "queries": [
     {
@@ -57,94 +245,8 @@ FORMATO OBRIGATÓRIO:
 }
 """.strip()
 
-    user_prompt = f"""
-TABLE_NAME: {TABLE_NAME}
-
-Esquema da tabela:
-{schema_desc}
-
-Pergunta do usuário:
-"{question}"
-
-Gere de 1 a 5 consultas seguindo o formato JSON especificado.
-""".strip()
-
-    chat = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        temperature=0,
-    )
-
-    content = chat.choices[0].message.content.strip()
-
-    if content.startswith("```"):
-        lines = content.splitlines()
-        lines = lines[1:]
-        if lines and lines[-1].strip().startswith("```"):
-            lines = lines[:-1]
-        content = "\n".join(lines).strip()
-
-    try:
-        data = json.loads(content)
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Falha ao parsear JSON de queries: {e}")
-
-    queries = data.get("queries")
-    if not isinstance(queries, list) or not queries:
-        raise HTTPException(status_code=500, detail="LLM não retornou 'queries' válidas.")
-
-    normalized: List[Dict[str, Any]] = []
-    for i, q in enumerate(queries[:5], start=1):
-        sql = (q.get("sql") or "").strip()
-        if not sql:
-            continue
-        if sql.startswith("```"):
-            lines = sql.splitlines()
-            lines = lines[1:]
-            if lines and lines[-1].strip().startswith("```"):
-                lines = lines[:-1]
-            sql = "\n".join(lines).strip()
-
-        normalized.append({
-            "id": q.get("id") or f"q{i}",
-            "title": q.get("title") or f"Query {i}",
-            "purpose": q.get("purpose") or "",
-            "sql": sql,
-        })
-
-    if not normalized:
-        raise HTTPException(status_code=500, detail="Nenhuma SQL válida gerada pelo LLM.")
 
-    return normalized
-
-
-def llm_generate_answer(question: str, query_results: List[Dict[str, Any]]) -> str:
-    if not USE_LLM:
-        raise RuntimeError("LLM não configurado (OPENAI_API_KEY ausente).")
-
-    payload = {
-        "question": question,
-        "queries": []
-    }
-
-    for q in query_results:
-        rows = q.get("rows") or []
-        payload["queries"].append({
-            "id": q["id"],
-            "title": q["title"],
-            "purpose": q.get("purpose", ""),
-            "sql": q["sql"],
-            "error": q.get("error"),
-            "total_rows": len(rows),
-            "rows": rows[:MAX_ROWS_FOR_LLM],
-        })
-
-    payload_json = json.dumps(payload, ensure_ascii=False, default=str)
-
-    system_prompt = """
+ANSWER_SYSTEM_PROMPT = """
 Você é um assistente de negócios que responde perguntas sobre faturamento
 com base em resultados de consultas SQL.
 
@@ -176,25 +278,680 @@ REGRAS NUMÉRICAS (MUITO IMPORTANTES):
 6) Escreva sempre em português, tom profissional, direto.
 7) Não use markdown.
 8) Se a pergunta pedir uma lista, você deve exibir tudo o que foi retornado do SQL e não apenas uma amostra.
-""".strip()
+9) Se "truncated" for true, a consulta tinha mais linhas do que as recebidas em "rows":
+   avise que apenas as primeiras linhas foram exibidas. Consultas com "single_row" trazem totais prontos.
 
-    user_prompt = f"""
-Dados de entrada (JSON):
+Com base nos resultados recebidos, responda à pergunta original do usuário de forma
+adequada (curta ou em formato de mini-relatório, conforme o tipo de pergunta),
+sempre respeitando as REGRAS NUMÉRICAS acima.
+""".strip()
 
-{payload_json}
 
-Com base nisso, responda à pergunta original do usuário de forma adequada
-(curta ou em formato de mini-relatório, conforme o tipo de pergunta),
-sempre respeitando as REGRAS NUMÉRICAS acima.
+# Ferramenta pela qual o modelo entrega as consultas. Com strict, os argumentos
+# chegam já validados contra o schema (como nos structured outputs).
+RUN_QUERIES_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "run_queries",
+        "description": "Executa de 1 a 5 consultas SELECT no PostgreSQL e devolve os resultados em JSON.",
+        "strict": True,
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "queries": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "id": {"type": "string"},
+                            "title": {"type": "string"},
+                            "sql": {"type": "string"},
+                            "purpose": {"type": "string"},
+                        },
+                        "required": ["id", "title", "sql", "purpose"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["queries"],
+            "additionalProperties": False,
+        },
+    },
+}
+RUN_QUERIES_CHOICE = {"type": "function", "function": {"name": "run_queries"}}
+# ids fixos das chamadas: a conversa da resposta é remontada a partir do plano (ou do cache)
+RUN_QUERIES_CALL_ID = "call_run_queries"
+REPAIR_CALL_ID = "call_run_queries_repair"
+
+# Última mensagem da chamada de resposta: as instruções já estão no system prompt
+ANSWER_TURN_PROMPT = (
+    "Com os resultados acima, escreva agora a resposta final ao usuário "
+    "seguindo as REGRAS NUMÉRICAS."
+)
+
+# Todas as consultas falharam e o modelo não as corrigiu: sem dado nenhum,
+# a chamada de resposta só pagaria tokens para dizer isso
+ALL_QUERIES_FAILED_MSG = (
+    "Não consegui executar nenhuma das consultas necessárias para responder "
+    "a esta pergunta. Tente reformulá-la ou ser mais específico."
+)
+
+# Rodada extra quando alguma consulta falhou: o modelo pode reenviar só as corrigidas
+REPAIR_PROMPT = """
+Algumas consultas acima falharam (campo "error": SQL insegura, colunas demais,
+erro do banco). Se for possível corrigi-las seguindo as REGRAS, chame run_queries
+novamente apenas com as consultas corrigidas. Se não for possível, responda só "OK".
 """.strip()
 
-    chat = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
+# Entra na chave das respostas em cache (compartilhadas via Redis e entre
+# deploys): trocar o modelo ou as instruções da resposta invalida as antigas.
+_ANSWER_CACHE_VERSION = _cache_key(ANSWER_MODEL, ANSWER_SYSTEM_PROMPT, ANSWER_TURN_PROMPT, REPAIR_PROMPT)
+
+
+def _schema_desc(schema: List[Dict[str, str]], samples: Dict[str, List[str]]) -> str:
+    schema_lines = []
+    for c in schema:
+        line = f"- {c['name']} ({c['type']})"
+        if c["name"] in samples:
+            line += " ex.: " + ", ".join(f"'{v}'" for v in samples[c["name"]])
+        schema_lines.append(line)
+    return "\n".join(schema_lines) if schema_lines else "(sem colunas)"
+
+
+def _build_queries_system_prompt(table_name: str, schema_desc: str) -> str:
+    """
+    System prompt do planejamento: regras (fixas) primeiro, depois
+    tabela/esquema (mudam raramente). Byte a byte idêntico enquanto o esquema
+    não muda, formando um prefixo estável que o planejamento e a correção
+    reaproveitam do cache da OpenAI.
+    """
+    return f"""{QUERIES_SYSTEM_PROMPT}
+
+TABLE_NAME: {table_name}
+
+Esquema da tabela:
+{schema_desc}
+
+Gere de 1 a 5 consultas e envie-as pela ferramenta run_queries."""
+
+
+# Mesmo TTL do esquema; warm_queries_prompt o limpa quando o esquema é recarregado
+@ttl_cache(maxsize=8, ttl=SCHEMA_CACHE_TTL)
+def _system_prompt(table_name: str) -> str:
+    """System prompt pronto: descrição do esquema montada uma vez, não por pergunta."""
+    schema_desc = _schema_desc(get_table_schema(table_name), get_column_samples(table_name))
+    return _build_queries_system_prompt(table_name, schema_desc)
+
+
+# Única parte da mensagem inicial que muda a cada pergunta
+QUESTION_TEMPLATE = 'Pergunta do usuário:\n"{question}"'
+
+
+def _planning_messages(question: str) -> List[Dict[str, Any]]:
+    """
+    Início da conversa do planejamento (system + pergunta). É o prefixo comum
+    ao planejamento e à rodada de correção, que já o encontra no cache da OpenAI.
+    """
+    return [
+        {"role": "system", "content": _system_prompt(TABLE_NAME)},
+        {"role": "user", "content": QUESTION_TEMPLATE.format(question=question)},
+    ]
+
+
+def _answer_messages(question: str) -> List[Dict[str, Any]]:
+    """
+    Início da conversa da resposta: só as instruções da resposta e a pergunta.
+    As regras de SQL e o esquema ficam de fora (o modelo da resposta não
+    planeja nada e não compartilha o cache do planejamento).
+    """
+    return [
+        {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+        {"role": "user", "content": QUESTION_TEMPLATE.format(question=question)},
+    ]
+
+
+def warm_queries_prompt() -> None:
+    """
+    Busca o esquema (e as amostras de valores) e monta o system prompt
+    antecipadamente (startup / após flush do esquema), para a primeira
+    pergunta já encontrar tudo pronto e o mesmo prefixo em cache na OpenAI.
+    """
+    _system_prompt.cache_clear()
+    _system_prompt(TABLE_NAME)
+
+
+def embed_question(question: str) -> np.ndarray | None:
+    """
+    Gera o embedding (normalizado) da pergunta para o cache semântico.
+    Em caso de falha devolve None e o fluxo segue sem cache semântico.
+    """
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+
+    key = normalize_question(question)
+    with _cache_lock:
+        cached = _embedding_cache.get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        resp = client.embeddings.create(model=EMBEDDING_MODEL, input=question)
+    except Exception as e:
+        print(f"[AGENT] Falha ao gerar embedding da pergunta: {e}")
+        return None
+
+    vector = np.asarray(resp.data[0].embedding, dtype=np.float32)
+    norm = float(np.linalg.norm(vector))
+    if norm == 0.0:
+        return None
+    vector /= norm
+
+    with _cache_lock:
+        _embedding_cache[key] = vector
+    return vector
+
+
+def _same_intent(question: str, cached_question: str) -> bool:
+    """
+    Verificação da zona cinza: pergunta ao LLM (1 token) se as duas perguntas
+    pedem exatamente a mesma informação.
+    """
+    try:
+        chat = client.chat.completions.create(
+            model=VERIFIER_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Responda apenas SIM ou NAO: as duas perguntas sobre faturamento pedem "
+                        "exatamente a mesma informação (mesma métrica, período e filtros)?"
+                    ),
+                },
+                {"role": "user", "content": f'1) "{question}"\n2) "{cached_question}"'},
+            ],
+            temperature=0,
+            max_tokens=1,
+        )
+    except Exception as e:
+        print(f"[AGENT] Falha na verificação do cache semântico: {e}")
+        return False
+
+    content = chat.choices[0].message.content or ""
+    return content.strip().upper().startswith("S")
+
+
+def response_cache_key(question: str) -> str:
+    """Chave exata da resposta completa: pergunta normalizada + esquema atual."""
+    scope = schema_fingerprint(get_table_schema(TABLE_NAME))
+    return _cache_key(normalize_question(question), scope)
+
+
+def lookup_cached_response(question: str) -> Dict[str, Any] | None:
+    """
+    Procura uma resposta completa (answer + debug_sql) de uma pergunta
+    equivalente já respondida. Similaridade >= RESPONSE_CACHE_HIT é hit direto;
+    na zona cinza, só vale se o verificador confirmar a mesma intenção.
+    Antes de tudo, o cache exato (pergunta normalizada + esquema); o embedding
+    já vai para o pool em paralelo com essa leitura (ida ao Redis) e só é
+    esperado se ela der miss.
+    """
+    vector_future = _prefetch_pool.submit(embed_question, question)
+
+    scope = schema_fingerprint(get_table_schema(TABLE_NAME))
+    cached = respcache.get(_cache_key(normalize_question(question), scope))
+    if cached is not None:
+        vector_future.cancel()
+        return cached
+
+    vector = vector_future.result()
+    if vector is None:
+        return None
+
+    found = _semantic_responses.search(vector, scope)
+    if found is None:
+        return None
+
+    payload, score = found
+    verdict = _semantic_responses.classify(score, verify=True)
+    if verdict == "hit":
+        return payload
+    if verdict == "gray":
+        accepted = _same_intent(question, payload["question"])
+        _semantic_responses.report_verified(accepted)
+        if accepted:
+            return payload
+    return None
+
+
+def store_response(question: str, answer: str, debug_sql: str | None) -> None:
+    """
+    Grava a resposta no cache exato já (a próxima pergunta igual a encontra)
+    e deixa o cache semântico, que pode precisar do embedding, para o pool.
+    """
+    normalized = normalize_question(question)
+    is_open = _OPEN_WINDOW_RE.search(normalized) is not None
+    ttl = RESPONSE_CACHE_TTL_OPEN if is_open else RESPONSE_CACHE_TTL
+    payload = {"question": question, "answer": answer, "debug_sql": debug_sql}
+    respcache.put(response_cache_key(question), payload, ttl)
+    _background_pool.submit(_store_semantic_response, question, payload, ttl)
+
+
+def _store_semantic_response(question: str, payload: Dict[str, Any], ttl: int) -> None:
+    scope = schema_fingerprint(get_table_schema(TABLE_NAME))
+    vector = embed_question(question)
+    if vector is not None:
+        _semantic_responses.add(vector, scope, payload, ttl=ttl)
+
+
+def clear_response_cache() -> None:
+    respcache.clear()
+    _semantic_responses.clear()
+
+
+def semantic_cache_stats() -> Dict[str, Dict[str, Any]]:
+    """Limiares e contadores dos caches semânticos (deste worker)."""
+    return {
+        "queries": _semantic_queries.stats(),
+        "answers": _semantic_answers.stats(),
+        "responses": _semantic_responses.stats(),
+    }
+
+
+def llm_generate_queries(
+    question: str,
+    on_query: Callable[[Dict[str, Any]], None] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    Plano de consultas da pergunta (caches exato/semântico ou LLM).
+    Quando o plano vem do LLM, on_query é chamado com cada consulta assim que
+    ela termina de chegar no stream, para o banco começar antes do fim do plano.
+
+    As consultas devolvidas são as mesmas guardadas nos caches (sem cópia):
+    são só lidas, e _run_one monta um dict novo para cada resultado.
+    """
+    if not USE_LLM:
+        raise RuntimeError("LLM não configurado (OPENAI_API_KEY ausente).")
+
+    # Embedding e esquema não dependem um do outro: o embedding vai
+    # para o pool enquanto o esquema é buscado nesta thread.
+    vector_future = _prefetch_pool.submit(embed_question, question)
+
+    schema = get_table_schema(TABLE_NAME)
+    fingerprint = schema_fingerprint(schema)
+
+    cache_key = _cache_key(normalize_question(question), fingerprint)
+    with _cache_lock:
+        cached = _queries_cache.get(cache_key)
+    if cached is not None:
+        vector_future.cancel()
+        return cached
+
+    vector = vector_future.result()
+    if vector is not None:
+        cached = _semantic_queries.lookup(vector, fingerprint)
+        if cached is not None:
+            with _cache_lock:
+                _queries_cache[cache_key] = cached
+            return cached
+
+    normalized = _queries_flight.do(
+        cache_key,
+        lambda: _request_queries(question, schema, fingerprint, cache_key, vector, on_query),
+    )
+    return normalized
+
+
+def _request_queries(
+    question: str,
+    schema: List[Dict[str, str]],
+    fingerprint: str,
+    cache_key: str,
+    vector: np.ndarray | None,
+    on_query: Callable[[Dict[str, Any]], None] | None = None,
+) -> List[Dict[str, Any]]:
+    """Chamada ao LLM que gera as queries; o resultado vai para os dois caches."""
+    stream = client.chat.completions.create(
+        model=QUERIES_MODEL,
+        messages=_planning_messages(question),
+        temperature=0,
+        max_tokens=QUERIES_MAX_TOKENS,
+        stream=True,
+        stream_options={"include_usage": True},
+        tools=[RUN_QUERIES_TOOL],
+        tool_choice=RUN_QUERIES_CHOICE,
+        extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+    )
+
+    normalized: List[Dict[str, Any]] = []
+    for i, q in enumerate(_iter_streamed_queries(stream), start=1):
+        if i > 5:
+            continue  # consome o stream até o fim; só as 5 primeiras valem
+        query = _normalize_query(q, i)
+        if query is None:
+            continue
+        normalized.append(query)
+        if on_query is not None:
+            on_query(query)
+
+    if not normalized:
+        raise HTTPException(status_code=500, detail="Nenhuma SQL válida gerada pelo LLM.")
+
+    with _cache_lock:
+        _queries_cache[cache_key] = normalized
+    if vector is not None:
+        _semantic_queries.add(vector, fingerprint, normalized)
+        # Grava o plano fora do caminho da requisição
+        _background_pool.submit(_persist_queries, fingerprint, question, vector, normalized)
+
+    return normalized
+
+
+def _normalize_query(q: Dict[str, Any], i: int) -> Dict[str, Any] | None:
+    """Consulta do LLM no formato interno (sem cerca de markdown); None se não tiver SQL."""
+    sql = q.get("sql") or ""
+    fenced = _FENCE_RE.match(sql)
+    sql = (fenced.group(1) if fenced else sql).strip()
+    if not sql:
+        return None
+    return {
+        "id": q.get("id") or f"q{i}",
+        "title": q.get("title") or f"Query {i}",
+        "purpose": q.get("purpose") or "",
+        "sql": sql,
+    }
+
+
+def _iter_streamed_queries(stream) -> Iterator[Dict[str, Any]]:
+    """
+    Lê em streaming os argumentos da chamada a run_queries e devolve cada
+    objeto de "queries" assim que ele se fecha. Os argumentos seguem o schema
+    strict de RUN_QUERIES_TOOL: {"queries": [{...}, {...}]}.
+    """
+    buf = ""
+    pos = -1  # posição logo após o "[" da lista de queries
+    # Até onde o buffer já foi tentado sem fechar um objeto: o objeto só pode
+    # terminar num "}" que chegou depois disso, então não vale reparsear antes
+    tried = 0
+    refusal: List[str] = []
+    called = False
+
+    for chunk in stream:
+        if chunk.usage is not None:
+            _log_usage("planejamento", chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.refusal:
+            refusal.append(delta.refusal)
+        for call in delta.tool_calls or ():
+            called = True
+            if call.function and call.function.arguments:
+                buf += call.function.arguments
+
+        if pos < 0:
+            start = buf.find("[")
+            if start < 0:
+                continue
+            pos = start + 1
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf) or buf[pos] != "{":
+                break
+            if buf.find("}", max(pos, tried)) < 0:
+                break
+            try:
+                obj, pos = _json_decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                tried = len(buf)
+                break  # objeto ainda incompleto: espera o próximo pedaço
+            if isinstance(obj, dict):
+                yield obj
+
+    if refusal:
+        raise HTTPException(status_code=500, detail=f"LLM recusou gerar queries: {''.join(refusal)}")
+    if not called:
+        raise HTTPException(status_code=500, detail="LLM não chamou a ferramenta run_queries.")
+
+
+def _persist_queries(
+    fingerprint: str,
+    question: str,
+    vector: np.ndarray,
+    queries: List[Dict[str, Any]],
+) -> None:
+    try:
+        save_query_template(fingerprint, normalize_question(question), vector.tobytes(), to_json(queries))
+    except Exception as e:
+        print(f"[AGENT] Falha ao gravar plano de consultas: {e}")
+
+
+def load_saved_queries() -> int:
+    """
+    Recarrega nos caches (exato e semântico) os planos já gerados para o
+    esquema atual: perguntas vistas antes de um restart não voltam ao LLM.
+    Devolve quantos planos foram carregados.
+    """
+    if not SEMANTIC_CACHE_ENABLED:
+        return 0
+
+    fingerprint = schema_fingerprint(get_table_schema(TABLE_NAME))
+    if fingerprint in _loaded_template_scopes:
+        return 0
+
+    rows = load_query_templates(fingerprint, SEMANTIC_CACHE_MAXSIZE)
+    for row in rows:
+        vector = np.frombuffer(row["embedding"], dtype=np.float32)
+        queries = row["queries"]
+        _semantic_queries.add(vector, fingerprint, queries)
+        with _cache_lock:
+            _queries_cache[_cache_key(row["question"], fingerprint)] = queries
+    _loaded_template_scopes.add(fingerprint)
+    return len(rows)
+
+
+def llm_stream_answer(question: str, query_results: List[Dict[str, Any]]) -> Iterator[str]:
+    """
+    Gera a resposta final em pedaços, conforme o modelo devolve os tokens.
+    Respostas em cache saem num único pedaço; a resposta completa só entra
+    no cache depois que o stream termina.
+
+    A conversa da resposta (ANSWER_MODEL) leva as instruções da resposta, a
+    pergunta, a chamada a run_queries com o plano e o resultado da ferramenta.
+    Se alguma consulta falhou, o modelo do planejamento ganha antes uma rodada
+    (na conversa dele) para reenviá-la corrigida; o resultado entra aqui.
+    """
+    if not USE_LLM:
+        raise RuntimeError("LLM não configurado (OPENAI_API_KEY ausente).")
+
+    plan_json = _plan_json(query_results)
+    results_json = _results_json(query_results)
+    cache_key = "answer:" + _cache_key(
+        _ANSWER_CACHE_VERSION, normalize_question(question), plan_json, results_json
+    )
+    cached = respcache.get(cache_key)
+    if cached is not None:
+        yield cached["answer"]
+        return
+
+    # No cache semântico da resposta, o scope são os próprios resultados:
+    # paráfrases só reaproveitam a resposta se os dados forem idênticos.
+    results_scope = _cache_key(plan_json, results_json)
+    vector = embed_question(question)
+    if vector is not None:
+        cached = _semantic_answers.lookup(vector, results_scope)
+        if cached is not None:
+            respcache.put(cache_key, {"answer": cached}, LLM_CACHE_TTL)
+            yield cached
+            return
+
+    plan_round = _tool_round(RUN_QUERIES_CALL_ID, plan_json, results_json)
+    messages = _answer_messages(question) + plan_round
+    if any(q.get("error") for q in query_results):
+        repair = _repair_round(_planning_messages(question) + plan_round)
+        if not repair and all(q.get("error") for q in query_results):
+            yield ALL_QUERIES_FAILED_MSG
+            return
+        messages += repair
+    messages.append({"role": "system", "content": ANSWER_TURN_PROMPT})
+
+    # A tool declarada explica as chamadas a run_queries do histórico;
+    # tool_choice="none": o modelo só responde em texto.
+    stream = client.chat.completions.create(
+        model=ANSWER_MODEL,
+        messages=messages,
         temperature=0,
+        stream=True,
+        stream_options={"include_usage": True},
+        tools=[RUN_QUERIES_TOOL],
+        tool_choice="none",
+        extra_body={"prompt_cache_key": ANSWER_PROMPT_CACHE_KEY},
+    )
+
+    parts: List[str] = []
+    for chunk in stream:
+        if chunk.usage is not None:
+            _log_usage("resposta", chunk.usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            yield delta
+
+    answer = "".join(parts).strip()
+
+    respcache.put(cache_key, {"answer": answer}, LLM_CACHE_TTL)
+    if vector is not None:
+        _semantic_answers.add(vector, results_scope, answer)
+
+
+def _log_usage(step: str, usage) -> None:
+    """
+    Tokens da chamada; "em cache" é o prefixo reaproveitado pelo prompt caching
+    da OpenAI (só vale a partir de 1024 tokens de prefixo idêntico).
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    print(
+        f"[AGENT] LLM {step}: {usage.prompt_tokens} tokens de prompt "
+        f"({cached} em cache), {usage.completion_tokens} gerados"
     )
 
-    return chat.choices[0].message.content.strip()
+
+def _plan_json(queries: List[Dict[str, Any]]) -> str:
+    """Argumentos da chamada a run_queries: id/título/SQL/objetivo de cada consulta."""
+    return to_json({
+        "queries": [
+            {"id": q["id"], "title": q["title"], "sql": q["sql"], "purpose": q.get("purpose") or ""}
+            for q in queries
+        ]
+    })
+
+
+def _results_json(
+    query_results: List[Dict[str, Any]],
+    budget_bytes: int = ROW_MARSHAL_BUDGET_BYTES,
+) -> str:
+    """
+    Resultado da ferramenta: só o que o banco devolveu. As linhas chegam como
+    JSON pronto do Postgres (rows_json); só os metadados de cada query passam
+    pelo orjson e o array é concatenado cru. Serializado uma única vez: vira
+    a chave de cache e o corpo do prompt.
+
+    Todas as queries vão numa única mensagem; MAX_ROWS_FOR_LLM e budget_bytes
+    são divididos entre elas e uma query que passa da sua parte é cortada.
+    """
+    n = max(len(query_results), 1)
+    budget = budget_bytes // n
+    row_cap = max(MIN_ROWS_PER_QUERY, MAX_ROWS_FOR_LLM // n)
+    parts: List[str] = []
+    for q in query_results:
+        row_count = q.get("row_count") or 0
+        rows_json = q.get("rows_json") or "[]"
+        truncated = bool(q.get("truncated"))
+        if row_count > 1 and (row_count > row_cap or len(rows_json) > budget):
+            rows_json, row_count = _fit_rows(rows_json, budget, row_cap)
+            truncated = True
+
+        item: Dict[str, Any] = {"id": q["id"], "row_count": row_count}
+        # Campos vazios só gastam tokens: error/truncated entram apenas se houver conteúdo
+        if q.get("error"):
+            item["error"] = q["error"]
+        if truncated:
+            item["truncated"] = True
+        elif row_count == 1:
+            # Linha única = total já consolidado pelo banco; destaca para o modelo citar
+            item["single_row"] = True
+        head = to_json(item)
+        parts.append(f'{head[:-1]},"rows":{rows_json}}}')
+    return "[" + ",".join(parts) + "]"
+
+
+def _fit_rows(rows_json: str, budget: int, max_rows: int) -> Tuple[str, int]:
+    """
+    Primeiras linhas (até max_rows) que cabem em ~budget caracteres, pelo
+    tamanho médio da linha.
+    """
+    rows = orjson.loads(rows_json)
+    keep = min(max_rows, max(1, len(rows) * budget // len(rows_json)))
+    return orjson.dumps(rows[:keep]).decode(), min(keep, len(rows))
+
+
+def _tool_round(call_id: str, plan_json: str, results_json: str) -> List[Dict[str, Any]]:
+    """Chamada do assistente a run_queries + resposta da ferramenta."""
+    return [
+        {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [{
+                "id": call_id,
+                "type": "function",
+                "function": {"name": "run_queries", "arguments": plan_json},
+            }],
+        },
+        {"role": "tool", "tool_call_id": call_id, "content": results_json},
+    ]
+
+
+def _repair_round(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Dá ao modelo do planejamento (messages: a conversa dele até o resultado
+    da ferramenta) uma chance de corrigir as consultas que falharam. Devolve a
+    rodada da correção (chamada + resultado) para a conversa da resposta, ou
+    vazio se ele não corrigir nada.
+    """
+    repair = [{"role": "system", "content": REPAIR_PROMPT}]
+    try:
+        chat = client.chat.completions.create(
+            model=QUERIES_MODEL,
+            messages=messages + repair,
+            temperature=0,
+            max_tokens=QUERIES_MAX_TOKENS,
+            tools=[RUN_QUERIES_TOOL],
+            tool_choice="auto",
+            extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+        )
+        if chat.usage is not None:
+            _log_usage("correção", chat.usage)
+        tool_calls = chat.choices[0].message.tool_calls
+        if not tool_calls:
+            return []
+        raw = orjson.loads(tool_calls[0].function.arguments).get("queries") or []
+    except Exception as e:
+        print(f"[AGENT] Falha ao corrigir consultas: {e}")
+        return []
+
+    retry = [q for q in (_normalize_query(q, i) for i, q in enumerate(raw[:5], start=1)) if q]
+    if not retry:
+        return []
+    results = run_queries(retry)
+    # Os resultados da primeira rodada continuam no prompt: a correção fica com
+    # o que sobrou do orçamento (no mínimo 1/4 dele), não com um orçamento inteiro
+    used = len(messages[-1]["content"])
+    budget = max(ROW_MARSHAL_BUDGET_BYTES - used, ROW_MARSHAL_BUDGET_BYTES // 4)
+    return _tool_round(REPAIR_CALL_ID, _plan_json(retry), _results_json(results, budget))
+
+
+def llm_generate_answer(question: str, query_results: List[Dict[str, Any]]) -> str:
+    return "".join(llm_stream_answer(question, query_results)).strip()
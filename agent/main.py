@@ -1,36 +1,249 @@
+from typing import Any, Dict, List, Tuple
+
+import anyio.to_thread
 from fastapi import FastAPI, HTTPException
+from openai import APITimeoutError
+import orjson
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
-from config import USE_LLM
+from config import USE_LLM, METRICS_ENABLED, THREADPOOL_SIZE, TABLE_NAME
 from models import AskRequest, AgentResponse
-from llm import llm_generate_queries, llm_generate_answer
-from utils import run_queries
+from db import get_table_schema, get_column_samples, listen_schema_changes, warm_pool
+from llm import (
+    clear_response_cache,
+    llm_generate_queries,
+    llm_generate_answer,
+    llm_stream_answer,
+    load_saved_queries,
+    lookup_cached_response,
+    normalize_question,
+    response_cache_key,
+    semantic_cache_stats,
+    store_response,
+    warm_queries_prompt,
+)
+from metrics import match_metric, refresh_metrics, start_metrics_refresher
+from singleflight import SingleFlight
+from utils import clear_result_cache, run_queries, start_query
+
+app = FastAPI(title="WeBox Agent Service", default_response_class=ORJSONResponse)
+
+# Rajadas da mesma pergunta (cache ainda vazio) rodam a análise uma vez só
+_agent_flight = SingleFlight()
+
+
+@app.on_event("startup")
+def startup():
+    # Os handlers são síncronos (rodam no threadpool); com o pool padrão
+    # de 40 threads, perguntas longas enfileiram as demais.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+    try:
+        warm_pool()
+    except Exception as e:
+        print(f"[AGENT] Não foi possível pré-abrir conexões com o banco: {e}")
+    if USE_LLM:
+        try:
+            warm_queries_prompt()
+        except Exception as e:
+            print(f"[AGENT] Não foi possível pré-carregar o esquema: {e}")
+        try:
+            print(f"[AGENT] {load_saved_queries()} planos de consulta carregados do banco.")
+        except Exception as e:
+            print(f"[AGENT] Não foi possível carregar os planos de consulta: {e}")
+    if METRICS_ENABLED:
+        start_metrics_refresher()
+    listen_schema_changes(_on_schema_changed, _on_data_changed)
+
+
+def _reload_schema() -> None:
+    get_table_schema.cache_clear()
+    get_column_samples.cache_clear()
+    clear_response_cache()
+    if USE_LLM:
+        warm_queries_prompt()
+        load_saved_queries()
+    if METRICS_ENABLED:
+        refresh_metrics()
+
+
+def _on_schema_changed(table_name: str) -> None:
+    if table_name != TABLE_NAME:
+        return
+    print(f"[AGENT] Esquema de {table_name} alterado pelo ETL; recarregando.")
+    try:
+        _reload_schema()
+    except Exception as e:
+        print(f"[AGENT] Falha ao recarregar esquema: {e}")
+
+
+def _on_data_changed(table_name: str) -> None:
+    """
+    O ETL carregou linhas: respostas inteiras em cache (exatas e semânticas),
+    resultados de SQL e totais pré-calculados ficaram velhos. Os planos de
+    consulta continuam valendo (dependem só do esquema).
+    """
+    if table_name != TABLE_NAME:
+        return
+    print(f"[AGENT] Dados de {table_name} carregados pelo ETL; limpando caches de resposta.")
+    try:
+        clear_response_cache()
+        clear_result_cache()
+        if METRICS_ENABLED:
+            refresh_metrics()
+    except Exception as e:
+        print(f"[AGENT] Falha ao limpar caches após carga: {e}")
+
+
+@app.post("/admin/flush-schema")
+def flush_schema():
+    """Descarta o esquema em cache (ex.: logo após o ETL criar colunas novas) e recarrega."""
+    _reload_schema()
+    return {"status": "ok"}
+
+
+@app.get("/admin/cache-stats")
+def cache_stats():
+    """Limiares (o de respostas se ajusta sozinho) e contadores dos caches semânticos."""
+    return semantic_cache_stats()
+
+
+LLM_TIMEOUT_MSG = "O módulo de IA demorou demais para responder. Tente novamente em instantes."
+
+LLM_UNAVAILABLE_MSG = (
+    "Desculpe, o módulo de IA não está disponível no momento, "
+    "então não consigo gerar uma resposta baseada nos seus dados. "
+    "Tente novamente mais tarde ou habilite a OPENAI_API_KEY."
+)
 
-app = FastAPI(title="WeBox Agent Service")
 
 @app.post("/run-agent", response_model=AgentResponse)
 def run_agent(req: AskRequest):
     if not USE_LLM:
-        msg = (
-            "Desculpe, o módulo de IA não está disponível no momento, "
-            "então não consigo gerar uma resposta baseada nos seus dados. "
-            "Tente novamente mais tarde ou habilite a OPENAI_API_KEY."
-        )
-        return AgentResponse(answer=msg, debug_sql=None)
+        return AgentResponse(answer=LLM_UNAVAILABLE_MSG, debug_sql=None)
 
-    try:
-        queries = llm_generate_queries(req.question)
-        results = run_queries(queries)
-        answer = llm_generate_answer(req.question, results)
+    # Totais consolidados comuns saem da camada de métricas, sem LLM nem SQL
+    if METRICS_ENABLED:
+        metric = match_metric(normalize_question(req.question))
+        if metric is not None:
+            answer, metric_sql = metric
+            return AgentResponse(answer=answer, debug_sql=f"-- Métrica pré-calculada\n{metric_sql}")
 
-        debug_sql_blocks = [f"-- {q['title']}\n{q['sql']}" for q in queries]
-        debug_sql = "\n\n".join(debug_sql_blocks) if debug_sql_blocks else None
+    try:
+        # Pergunta equivalente já respondida: devolve direto, sem LLM nem banco
+        cached = lookup_cached_response(req.question)
+        if cached is not None:
+            return AgentResponse(answer=cached["answer"], debug_sql=cached["debug_sql"])
 
-        return AgentResponse(answer=answer, debug_sql=debug_sql)
+        return _agent_flight.do(
+            response_cache_key(req.question),
+            lambda: _analyze(req.question),
+        )
 
     except HTTPException:
         raise
+    except APITimeoutError:
+        # Timeout do provedor (já esgotadas as retentativas) é 504, não erro nosso
+        raise HTTPException(status_code=504, detail=LLM_TIMEOUT_MSG)
     except Exception as e:
         return AgentResponse(
             answer=f"Não foi possível concluir a análise desta pergunta: {e}",
             debug_sql=None,
         )
+
+
+def _plan_and_run(question: str) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Gera o plano e executa as consultas. Cada consulta vai para o banco assim
+    que chega do stream do LLM, em paralelo com o resto do plano.
+    """
+    started = []
+    queries = llm_generate_queries(question, on_query=lambda q: started.append(start_query(q)))
+    return queries, run_queries(queries, started)
+
+
+def _analyze(question: str) -> AgentResponse:
+    queries, results = _plan_and_run(question)
+    answer = llm_generate_answer(question, results)
+
+    debug_sql_blocks = [f"-- {q['title']}\n{q['sql']}" for q in queries]
+    debug_sql = "\n\n".join(debug_sql_blocks) if debug_sql_blocks else None
+
+    # Só guarda análises completas (sem query com erro)
+    if not any(r.get("error") for r in results):
+        store_response(question, answer, debug_sql)
+
+    return AgentResponse(answer=answer, debug_sql=debug_sql)
+
+
+# Proxies (nginx etc.) não devem segurar os eventos em buffer nem cachear o stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+def _sse(data: Any, event: str | None = None) -> str:
+    """Um evento Server-Sent Events; data vai em JSON (quebras de linha escapadas)."""
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {orjson.dumps(data).decode()}\n\n"
+
+
+def _sse_response(debug_sql: str | None, chunks) -> StreamingResponse:
+    """
+    Stream SSE: um evento "debug_sql" primeiro, depois um evento por pedaço
+    da resposta e, por fim, "done". Os cabeçalhos (200) já saíram: uma falha
+    no meio do stream (timeout do LLM etc.) vira um evento "error" antes do
+    "done", em vez de a conexão cair sem explicação.
+    """
+    def events():
+        yield _sse(debug_sql, "debug_sql")
+        try:
+            for chunk in chunks:
+                yield _sse(chunk)
+        except APITimeoutError:
+            yield _sse(LLM_TIMEOUT_MSG, "error")
+        except Exception as e:
+            print(f"[AGENT] Erro no stream da resposta: {e}")
+            yield _sse("Não foi possível concluir a resposta. Tente novamente.", "error")
+        yield _sse(None, "done")
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+
+@app.post("/run-agent/stream")
+def run_agent_stream(req: AskRequest):
+    """
+    Mesma análise do /run-agent, mas em Server-Sent Events: o SQL usado sai
+    no primeiro evento e a resposta final à medida que o LLM gera os tokens.
+    """
+    if not USE_LLM:
+        return _sse_response(None, [LLM_UNAVAILABLE_MSG])
+
+    if METRICS_ENABLED:
+        metric = match_metric(normalize_question(req.question))
+        if metric is not None:
+            answer, metric_sql = metric
+            return _sse_response(f"-- Métrica pré-calculada\n{metric_sql}", [answer])
+
+    try:
+        cached = lookup_cached_response(req.question)
+        if cached is not None:
+            return _sse_response(cached["debug_sql"], [cached["answer"]])
+
+        queries, results = _plan_and_run(req.question)
+    except HTTPException:
+        raise
+    except APITimeoutError:
+        raise HTTPException(status_code=504, detail=LLM_TIMEOUT_MSG)
+    except Exception as e:
+        msg = f"Não foi possível concluir a análise desta pergunta: {e}"
+        return _sse_response(None, [msg])
+
+    debug_sql = "\n\n".join(f"-- {q['title']}\n{q['sql']}" for q in queries) or None
+
+    def stream_and_store():
+        parts = []
+        for chunk in llm_stream_answer(req.question, results):
+            parts.append(chunk)
+            yield chunk
+        if not any(r.get("error") for r in results):
+            store_response(req.question, "".join(parts).strip(), debug_sql)
+
+    return _sse_response(debug_sql, stream_and_store())
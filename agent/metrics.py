@@ -0,0 +1,190 @@
+import re
+import threading
+import time
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Any, Tuple
+
+from config import (
+    TABLE_NAME,
+    METRICS_DATE_COLUMN,
+    METRICS_REFRESH_INTERVAL,
+)
+from sqlalchemy import text
+
+from db import get_table_schema, db_mcp_tool
+
+# Colunas que a camada de métricas precisa encontrar na tabela
+REQUIRED_COLS = {METRICS_DATE_COLUMN, "valor_bruto", "valor_liquido"}
+
+# Totais e quantidade de notas por ano + total geral (linha do ROLLUP, marcada por GROUPING)
+_YEAR_EXPR = f'EXTRACT(YEAR FROM "{METRICS_DATE_COLUMN}")::int'
+METRICS_SQL = f"""
+SELECT
+    {_YEAR_EXPR} AS ano,
+    GROUPING({_YEAR_EXPR}) = 1 AS geral,
+    SUM(valor_bruto) AS faturamento_bruto_total,
+    SUM(valor_liquido) AS faturamento_liquido_total,
+    COUNT(*) AS quantidade_notas
+FROM {TABLE_NAME}
+GROUP BY ROLLUP ({_YEAR_EXPR})
+""".strip()
+_METRICS_STMT = text(METRICS_SQL)
+
+# Intenções atendidas pela camada de métricas (perguntas já normalizadas).
+# Todas viram uma única regex com um grupo nomeado por intenção: uma passada
+# só classifica a pergunta, não importa quantas intenções existam.
+_INTENT_PATTERNS = {
+    # "qual o faturamento (bruto|líquido) total de 2024?"
+    "total": (
+        r"(?:qual (?:foi |e |é )?(?:o )?|quanto (?:foi )?(?:o )?)?"
+        r"faturamento (?:(?P<tipo>bruto|liquido|líquido) )?total"
+        r"(?: (?:de|em|do ano de|no ano de) (?P<ano>\d{4}))?"
+    ),
+    # "qual o faturamento por ano?" / "faturamento anual"
+    "por_ano": (
+        r"(?:qual (?:foi |e |é )?(?:o )?)?"
+        r"(?:faturamento (?:total )?(?:por ano|anual)|faturamento de cada ano)"
+    ),
+    # "quantas notas foram emitidas em 2024?" / "total de notas"
+    "notas": (
+        r"(?:quantas notas(?: fiscais)?(?: foram)?(?: emitidas)?"
+        r"|(?:qual (?:foi |e |é )?(?:o )?)?(?:total|quantidade|numero|número) de notas(?: fiscais)?(?: emitidas)?)"
+        r"(?: (?:no total|ao todo))?"
+        r"(?: (?:de|em|no ano de) (?P<ano_notas>\d{4}))?"
+    ),
+}
+INTENT_RE = re.compile(
+    "|".join(f"(?P<{name}>{pattern})" for name, pattern in _INTENT_PATTERNS.items())
+)
+
+# A classificação só depende do texto (os valores são lidos à parte), então
+# perguntas repetidas não refazem a varredura da regex.
+_match_intent = lru_cache(maxsize=1024)(INTENT_RE.fullmatch)
+
+# ano (None = total geral) -> {"bruto": ..., "liquido": ..., "notas": ...}
+_values: Dict[int | None, Dict[str, Any]] = {}
+_values_lock = threading.Lock()
+
+
+def _format_brl(value: Any) -> str:
+    """Formata valor como moeda brasileira (R$ 1.234,56)."""
+    text = f"{Decimal(str(value)):,.2f}"
+    return "R$ " + text.replace(",", "_").replace(".", ",").replace("_", ".")
+
+
+def refresh_metrics() -> None:
+    """
+    Recalcula os totais pré-agregados. Se a tabela ainda não tem as colunas
+    necessárias (ETL não rodou), a camada fica vazia e tudo segue pelo LLM.
+    """
+    global _values
+
+    columns = {c["name"] for c in get_table_schema(TABLE_NAME)}
+    if not REQUIRED_COLS <= columns:
+        with _values_lock:
+            _values = {}
+        return
+
+    values: Dict[int | None, Dict[str, Any]] = {}
+    for row in db_mcp_tool(_METRICS_STMT):
+        if row["ano"] is None and not row["geral"]:
+            continue  # linhas sem data não formam um ano
+        key = None if row["geral"] else row["ano"]
+        values[key] = {
+            "bruto": row["faturamento_bruto_total"],
+            "liquido": row["faturamento_liquido_total"],
+            "notas": row["quantidade_notas"],
+        }
+    with _values_lock:
+        _values = values
+
+
+def _refresh_loop() -> None:
+    while True:
+        try:
+            refresh_metrics()
+        except Exception as e:
+            print(f"[AGENT] Falha ao atualizar métricas: {e}")
+        time.sleep(METRICS_REFRESH_INTERVAL)
+
+
+def start_metrics_refresher() -> None:
+    """Sobe a thread que mantém os totais atualizados em segundo plano."""
+    thread = threading.Thread(target=_refresh_loop, name="metrics-refresher", daemon=True)
+    thread.start()
+
+
+def _answer_total(m: re.Match) -> str | None:
+    ano = int(m.group("ano")) if m.group("ano") else None
+    with _values_lock:
+        entry = _values.get(ano)
+    if not entry or entry["bruto"] is None:
+        return None
+
+    periodo = f"em {ano}" if ano is not None else "no período total registrado"
+    tipo = m.group("tipo")
+
+    if tipo == "bruto":
+        return f"O faturamento bruto total {periodo} foi de {_format_brl(entry['bruto'])}."
+    if tipo in ("liquido", "líquido"):
+        if entry["liquido"] is None:
+            return None
+        return f"O faturamento líquido total {periodo} foi de {_format_brl(entry['liquido'])}."
+
+    answer = f"O faturamento bruto total {periodo} foi de {_format_brl(entry['bruto'])}"
+    if entry["liquido"] is not None:
+        answer += f", com faturamento líquido de {_format_brl(entry['liquido'])}"
+    return answer + "."
+
+
+def _answer_por_ano(m: re.Match) -> str | None:
+    with _values_lock:
+        anos = sorted((ano, v) for ano, v in _values.items() if ano is not None)
+    if not anos:
+        return None
+
+    linhas = [
+        f"- {ano}: bruto {_format_brl(v['bruto'])}"
+        + (f", líquido {_format_brl(v['liquido'])}" if v["liquido"] is not None else "")
+        for ano, v in anos
+        if v["bruto"] is not None
+    ]
+    if not linhas:
+        return None
+    return "Faturamento por ano:\n" + "\n".join(linhas)
+
+
+def _answer_notas(m: re.Match) -> str | None:
+    ano = int(m.group("ano_notas")) if m.group("ano_notas") else None
+    with _values_lock:
+        entry = _values.get(ano)
+    if not entry:
+        return None
+
+    periodo = f"em {ano}" if ano is not None else "no período total registrado"
+    quantidade = f"{entry['notas']:,}".replace(",", ".")
+    return f"Foram emitidas {quantidade} notas {periodo}."
+
+
+# intenção -> função que monta a resposta a partir dos valores em cache
+_HANDLERS = {
+    "total": _answer_total,
+    "por_ano": _answer_por_ano,
+    "notas": _answer_notas,
+}
+
+
+def match_metric(normalized_question: str) -> Tuple[str, str] | None:
+    """
+    Responde perguntas de total consolidado direto da camada de métricas.
+    Devolve (resposta, sql) ou None quando a pergunta não casa / não há valor.
+    """
+    m = _match_intent(normalized_question)
+    if not m:
+        return None
+
+    answer = _HANDLERS[m.lastgroup](m)
+    if answer is None:
+        return None
+    return answer, METRICS_SQL
@@ -1,8 +1,9 @@
-from typing import Dict, Any
+from typing import Mapping, Any
 from pydantic import BaseModel
 
 
-Row = Dict[str, Any]
+# Linha de resultado (RowMapping do SQLAlchemy: acesso por nome, somente leitura)
+Row = Mapping[str, Any]
 
 
 class AskRequest(BaseModel):
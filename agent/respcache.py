@@ -0,0 +1,80 @@
+import threading
+import time
+from typing import Any, Dict
+
+import orjson
+from cachetools import TTLCache
+
+from config import REDIS_URL, RESPONSE_CACHE_MAXSIZE, RESPONSE_CACHE_TTL
+
+# Prefixo das chaves no Redis (o banco do Redis pode ser compartilhado)
+KEY_PREFIX = "webox:resp:"
+# Geração atual das chaves: clear() incrementa e as entradas antigas ficam
+# inalcançáveis para todos os workers/réplicas (o TTL as remove depois)
+GENERATION_KEY = KEY_PREFIX + "gen"
+
+if REDIS_URL:
+    import redis
+    _redis = redis.Redis.from_url(REDIS_URL, socket_timeout=0.2)
+else:
+    _redis = None
+
+# Sem Redis, cada worker do uvicorn mantém o próprio cache em memória.
+# O TTL de cada entrada é aplicado na leitura (TTLCache só tem TTL global).
+_local: TTLCache = TTLCache(maxsize=RESPONSE_CACHE_MAXSIZE, ttl=RESPONSE_CACHE_TTL)
+_local_lock = threading.Lock()
+
+
+def _redis_key(key: str) -> str:
+    generation = _redis.get(GENERATION_KEY)
+    return f"{KEY_PREFIX}{int(generation or 0)}:{key}"
+
+
+def get(key: str) -> Dict[str, Any] | None:
+    """
+    Busca pela chave exata: respostas completas (pergunta normalizada + esquema)
+    ou o texto final do LLM (prefixo "answer:", pergunta + plano + resultados).
+    Falha no Redis vira miss: o pedido segue pelo cache semântico/LLM.
+    """
+    if _redis is not None:
+        try:
+            raw = _redis.get(_redis_key(key))
+        except redis.RedisError as e:
+            print(f"[AGENT] Redis indisponível (get): {e}")
+            return None
+        return orjson.loads(raw) if raw else None
+
+    with _local_lock:
+        entry = _local.get(key)
+    if entry is None:
+        return None
+    payload, expires = entry
+    return payload if expires > time.monotonic() else None
+
+
+def put(key: str, payload: Dict[str, Any], ttl: int) -> None:
+    if _redis is not None:
+        try:
+            _redis.set(_redis_key(key), orjson.dumps(payload), ex=ttl)
+        except redis.RedisError as e:
+            print(f"[AGENT] Redis indisponível (set): {e}")
+        return
+
+    with _local_lock:
+        _local[key] = (payload, time.monotonic() + ttl)
+
+
+def clear() -> None:
+    """
+    Limpa o cache local ou, com Redis, avança a geração das chaves. Cada worker
+    recebe o NOTIFY e incrementa por conta própria; gerações puladas não importam.
+    """
+    if _redis is not None:
+        try:
+            _redis.incr(GENERATION_KEY)
+        except redis.RedisError as e:
+            print(f"[AGENT] Redis indisponível (incr): {e}")
+        return
+
+    with _local_lock:
+        _local.clear()
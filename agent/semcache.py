@@ -0,0 +1,187 @@
+import math
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+
+class SemanticCache:
+    """
+    Cache semântico em memória: guarda embeddings de perguntas já respondidas
+    e devolve o payload da pergunta mais parecida (similaridade de cosseno).
+
+    - Os vetores devem chegar normalizados (norma 1), então cosseno = produto interno.
+    - As entradas são agrupadas por "scope" (ex.: fingerprint do esquema), e só
+      competem entre si entradas do mesmo scope.
+    - Similaridade >= hit_threshold -> hit.
+    - Entre gray_threshold e hit_threshold -> "zona cinza": tratada como miss,
+      a pergunta segue para o LLM (verificação em dois estágios).
+    - Quando passa de maxsize, descarta as entradas mais antigas (FIFO).
+    - Cada entrada pode ter TTL próprio; entradas vencidas são ignoradas.
+    - Com threshold_range, o hit_threshold se ajusta a cada `window` buscas:
+      desce 0.01 se a taxa de hits ficou abaixo de target_hit_rate e sobe 0.02
+      se mais de max_reject_rate das buscas caíram na zona cinza com intenção
+      diferente (report_verified), sempre dentro de threshold_range.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        hit_threshold: float,
+        gray_threshold: float,
+        threshold_range: Tuple[float, float] | None = None,
+        target_hit_rate: float = 0.5,
+        max_reject_rate: float = 0.02,
+        window: int = 1000,
+    ):
+        self.maxsize = maxsize
+        self.hit_threshold = hit_threshold
+        self.gray_threshold = gray_threshold
+        self.threshold_range = threshold_range
+        self.target_hit_rate = target_hit_rate
+        self.max_reject_rate = max_reject_rate
+        self.window = window
+        # scope -> (vetores, payloads, instantes de expiração em time.monotonic())
+        self._scopes: Dict[str, Tuple[List[np.ndarray], List[Any], List[float]]] = {}
+        # scope -> (matriz com os vetores empilhados, expirações); refeita só
+        # depois de um add/descarte no scope, não a cada busca
+        self._matrices: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._order: List[str] = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.gray = 0
+        self.misses = 0
+        self.rejected = 0
+        # Contadores da janela atual do ajuste do limiar
+        self._window_lookups = 0
+        self._window_hits = 0
+        self._window_rejected = 0
+
+    def search(self, vector: np.ndarray, scope: str) -> Tuple[Any, float] | None:
+        """Vizinho mais próximo válido no scope: (payload, similaridade), sem aplicar limiares."""
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if not entry or not entry[0]:
+                return None
+
+            vectors, payloads, expires = entry
+            stacked = self._matrices.get(scope)
+            if stacked is None:
+                stacked = (np.vstack(vectors), np.asarray(expires))
+                self._matrices[scope] = stacked
+            matrix, expires_at = stacked
+
+            sims = matrix @ vector
+            sims[expires_at <= time.monotonic()] = -np.inf
+
+            best = int(np.argmax(sims))
+            score = float(sims[best])
+            if score == -np.inf:
+                return None
+            return payloads[best], score
+
+    def classify(self, score: float, verify: bool = False) -> str:
+        """
+        Conta e classifica uma similaridade como "hit", "gray" ou "miss".
+        Com verify=True, um "gray" só entra na janela do limiar quando o
+        chamador informar o resultado do verificador (report_verified).
+        """
+        with self._lock:
+            if score >= self.hit_threshold:
+                self.hits += 1
+                verdict = "hit"
+            elif score >= self.gray_threshold:
+                self.gray += 1
+                verdict = "gray"
+            else:
+                self.misses += 1
+                verdict = "miss"
+            if not (verify and verdict == "gray"):
+                self._record_lookup(verdict == "hit")
+            return verdict
+
+    def report_verified(self, accepted: bool) -> None:
+        """Resultado do verificador para um "gray" de classify(verify=True)."""
+        with self._lock:
+            if not accepted:
+                self.rejected += 1
+            self._record_lookup(False, rejected=not accepted)
+
+    def _record_lookup(self, hit: bool, rejected: bool = False) -> None:
+        """Conta a busca na janela e, ao fechá-la, ajusta o limiar. Chamada com o lock."""
+        if self.threshold_range is None:
+            return
+        self._window_lookups += 1
+        self._window_hits += hit
+        self._window_rejected += rejected
+        if self._window_lookups < self.window:
+            return
+
+        hit_rate = self._window_hits / self._window_lookups
+        reject_rate = self._window_rejected / self._window_lookups
+        threshold = self.hit_threshold
+        if reject_rate > self.max_reject_rate:
+            threshold += 0.02
+        elif hit_rate < self.target_hit_rate:
+            threshold -= 0.01
+        low, high = self.threshold_range
+        threshold = round(min(max(threshold, low), high), 4)
+
+        if threshold != self.hit_threshold:
+            print(
+                f"[AGENT] Limiar do cache semântico: {self.hit_threshold:.2f} -> {threshold:.2f} "
+                f"(hits {hit_rate:.0%}, rejeitadas {reject_rate:.0%})"
+            )
+            self.hit_threshold = threshold
+        self._window_lookups = self._window_hits = self._window_rejected = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "hit_threshold": self.hit_threshold,
+                "gray_threshold": self.gray_threshold,
+                "hits": self.hits,
+                "gray": self.gray,
+                "misses": self.misses,
+                "rejected": self.rejected,
+            }
+
+    def lookup(self, vector: np.ndarray, scope: str) -> Any | None:
+        found = self.search(vector, scope)
+        if found is None:
+            with self._lock:
+                self.misses += 1
+                self._record_lookup(False)
+            return None
+
+        payload, score = found
+        if self.classify(score) == "hit":
+            return payload
+        return None
+
+    def add(self, vector: np.ndarray, scope: str, payload: Any, ttl: float | None = None) -> None:
+        expires_at = time.monotonic() + ttl if ttl is not None else math.inf
+        with self._lock:
+            vectors, payloads, expires = self._scopes.setdefault(scope, ([], [], []))
+            vectors.append(vector)
+            payloads.append(payload)
+            expires.append(expires_at)
+            self._order.append(scope)
+            self._matrices.pop(scope, None)
+
+            while len(self._order) > self.maxsize:
+                oldest = self._order.pop(0)
+                old_vectors, old_payloads, old_expires = self._scopes[oldest]
+                old_vectors.pop(0)
+                old_payloads.pop(0)
+                old_expires.pop(0)
+                self._matrices.pop(oldest, None)
+                if not old_vectors:
+                    del self._scopes[oldest]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._scopes.clear()
+            self._order.clear()
+            self._matrices.clear()
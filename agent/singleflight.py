@@ -0,0 +1,41 @@
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict
+
+
+class SingleFlight:
+    """
+    Deduplica chamadas concorrentes com a mesma chave: a primeira thread
+    executa fn, as demais esperam e recebem o mesmo resultado (ou a mesma
+    exceção). Depois que a chamada termina a chave é liberada, então novas
+    requisições passam a depender dos caches normais.
+
+    Vale dentro do processo; cada worker do uvicorn tem o seu.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
@@ -0,0 +1,96 @@
+import pytest
+
+from semcache import SemanticCache
+
+
+def make_cache(hit=0.92, window=10, threshold_range=(0.88, 0.98)):
+    return SemanticCache(
+        maxsize=10,
+        hit_threshold=hit,
+        gray_threshold=0.85,
+        threshold_range=threshold_range,
+        target_hit_rate=0.5,
+        max_reject_rate=0.02,
+        window=window,
+    )
+
+
+def test_lowers_threshold_when_hit_rate_below_target():
+    cache = make_cache()
+    for _ in range(10):
+        cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.91)
+
+
+def test_keeps_threshold_when_hit_rate_meets_target():
+    cache = make_cache()
+    for _ in range(5):
+        cache.classify(0.99)
+    for _ in range(5):
+        cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.92)
+
+
+def test_threshold_only_changes_when_window_closes():
+    cache = make_cache()
+    for _ in range(9):
+        cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.92)
+    cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.91)
+
+
+def test_raises_threshold_when_verifier_rejects_too_many():
+    cache = make_cache()
+    for _ in range(9):
+        cache.classify(0.99)
+    assert cache.classify(0.9, verify=True) == "gray"
+    cache.report_verified(False)
+    assert cache.hit_threshold == pytest.approx(0.94)
+    assert cache.stats()["rejected"] == 1
+
+
+def test_rejection_counts_in_the_window_of_its_lookup():
+    cache = make_cache(window=2)
+    cache.classify(0.5)
+    # O gray só entra na janela com o resultado do verificador
+    assert cache.classify(0.9, verify=True) == "gray"
+    assert cache.hit_threshold == pytest.approx(0.92)
+    cache.report_verified(False)
+    assert cache.hit_threshold == pytest.approx(0.94)
+
+
+def test_accepted_gray_is_not_a_rejection():
+    cache = make_cache(window=2)
+    cache.classify(0.99)
+    cache.classify(0.9, verify=True)
+    cache.report_verified(True)
+    assert cache.hit_threshold == pytest.approx(0.92)
+    assert cache.stats()["rejected"] == 0
+
+
+def test_clamps_at_minimum():
+    cache = make_cache(hit=0.885)
+    for _ in range(10):
+        cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.88)
+    for _ in range(10):
+        cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.88)
+
+
+def test_clamps_at_maximum():
+    cache = make_cache(hit=0.97)
+    for _ in range(2):
+        for _ in range(9):
+            cache.classify(0.99)
+        cache.classify(0.9, verify=True)
+        cache.report_verified(False)
+    assert cache.hit_threshold == pytest.approx(0.98)
+
+
+def test_fixed_threshold_without_range():
+    cache = make_cache(threshold_range=None)
+    for _ in range(50):
+        cache.classify(0.5)
+    assert cache.hit_threshold == pytest.approx(0.92)
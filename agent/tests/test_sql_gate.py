@@ -0,0 +1,147 @@
+import pytest
+import sqlglot
+from sqlglot import exp
+
+from config import MAX_LIST_ROWS, MAX_ROWS
+from utils import enforce_sql_limits, is_safe_sql
+
+
+def _limit_of(sql: str) -> int:
+    limit = sqlglot.parse_one(sql, read="postgres").args["limit"]
+    if isinstance(limit, exp.Fetch):
+        return int(limit.args["count"].name)
+    return int(limit.expression.name)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT SUM(valor_bruto) FROM faturamento",
+        "SELECT cliente_id, COUNT(*) FROM public.faturamento GROUP BY cliente_id",
+        "WITH t AS (SELECT cliente_id FROM faturamento) SELECT * FROM t",
+        "SELECT 1 FROM faturamento UNION ALL SELECT 2 FROM faturamento",
+        "SELECT limit_amount FROM faturamento",
+    ],
+)
+def test_allows_plain_selects(sql):
+    assert is_safe_sql(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT 1 FROM faturamento; DELETE FROM faturamento",
+        "SELECT 1 FROM faturamento; SELECT 2 FROM faturamento",
+        "SELECT 1 FROM faturamento; DROP TABLE faturamento",
+    ],
+)
+def test_rejects_stacked_statements(sql):
+    assert not is_safe_sql(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "WITH d AS (DELETE FROM faturamento RETURNING *) SELECT * FROM d",
+        "WITH u AS (UPDATE faturamento SET cliente_id = 'x' RETURNING *) SELECT * FROM u",
+        "WITH i AS (INSERT INTO faturamento (cliente_id) VALUES ('x') RETURNING *) SELECT * FROM i",
+        "DELETE FROM faturamento",
+        "CREATE TABLE copia AS SELECT * FROM faturamento",
+        "DROP TABLE faturamento",
+        "ALTER TABLE faturamento ADD COLUMN x TEXT",
+    ],
+)
+def test_rejects_dml_and_ddl(sql):
+    assert not is_safe_sql(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * INTO copia FROM faturamento",
+        "SELECT * FROM faturamento FOR UPDATE",
+        "SELECT * FROM faturamento FOR SHARE",
+    ],
+)
+def test_rejects_select_into_and_row_locks(sql):
+    assert not is_safe_sql(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT * FROM etl_jobs",
+        "SELECT * FROM query_templates",
+        "SELECT usename, passwd FROM pg_catalog.pg_shadow",
+        "SELECT * FROM information_schema.tables",
+        "SELECT * FROM outro.faturamento",
+        "SELECT * FROM faturamento f JOIN etl_jobs j ON j.arquivo_nome = f.arquivo_nome",
+        "SELECT * FROM faturamento WHERE cliente_id IN (SELECT cliente_id FROM etl_jobs)",
+    ],
+)
+def test_rejects_tables_outside_allow_list(sql):
+    assert not is_safe_sql(sql)
+
+
+@pytest.mark.parametrize(
+    "sql",
+    [
+        "SELECT pg_sleep(10) FROM faturamento",
+        "SELECT pg_read_file('/etc/passwd') FROM faturamento",
+        "SELECT lo_import('/etc/passwd') FROM faturamento",
+        "SELECT * FROM faturamento WHERE dblink_exec('host=x', 'DROP TABLE t') = 'x'",
+        "SELECT dblink('host=x', 'SELECT 1') FROM faturamento",
+        "SELECT set_config('statement_timeout', '0', false) FROM faturamento",
+        "SELECT current_setting('data_directory') FROM faturamento",
+        "SELECT query_to_xml('DELETE FROM faturamento RETURNING 1', true, true, '') FROM faturamento",
+        "SELECT table_to_xml('query_templates', true, true, '') FROM faturamento",
+        "SELECT cursor_to_xml('c', 10, true, true, '') FROM faturamento",
+        "SELECT database_to_xmlschema(true, true, '') FROM faturamento",
+    ],
+)
+def test_rejects_admin_functions(sql):
+    assert not is_safe_sql(sql)
+
+
+def test_limit_all_is_capped():
+    sql = enforce_sql_limits("SELECT cliente_id FROM faturamento LIMIT ALL")
+    assert _limit_of(sql) == MAX_ROWS
+
+
+def test_oversized_limit_is_capped():
+    sql = enforce_sql_limits(f"SELECT cliente_id FROM faturamento LIMIT {MAX_ROWS * 10}")
+    assert _limit_of(sql) == MAX_ROWS
+
+
+def test_small_limit_is_kept():
+    sql = enforce_sql_limits("SELECT cliente_id FROM faturamento LIMIT 5")
+    assert _limit_of(sql) == 5
+
+
+def test_small_fetch_first_is_kept():
+    sql = enforce_sql_limits("SELECT cliente_id FROM faturamento FETCH FIRST 5 ROWS ONLY")
+    assert _limit_of(sql) == 5
+
+
+def test_oversized_fetch_first_is_capped():
+    sql = enforce_sql_limits(f"SELECT cliente_id FROM faturamento FETCH FIRST {MAX_ROWS * 10} ROWS ONLY")
+    assert _limit_of(sql) == MAX_ROWS
+
+
+def test_missing_limit_on_listing_uses_list_cap():
+    sql = enforce_sql_limits("SELECT cliente_id FROM faturamento")
+    assert _limit_of(sql) == MAX_LIST_ROWS
+
+
+def test_missing_limit_on_aggregate_uses_general_cap():
+    sql = enforce_sql_limits("SELECT cliente_id, SUM(valor_bruto) FROM faturamento GROUP BY cliente_id")
+    assert _limit_of(sql) == MAX_ROWS
+
+
+def test_column_named_like_limit_is_not_a_limit():
+    sql = enforce_sql_limits("SELECT limit_amount FROM faturamento WHERE limit_amount > 10")
+    assert _limit_of(sql) == MAX_LIST_ROWS
+    assert "limit_amount" in sql
+
+    sql = enforce_sql_limits("SELECT limit_amount FROM faturamento LIMIT 7")
+    assert _limit_of(sql) == 7
@@ -1,53 +1,244 @@
-from typing import Dict, Any, List
+import hashlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Any, List, Sequence, Tuple
 
-from config import MAX_ROWS, MAX_COLS
-from db import db_mcp_tool
+import sqlglot
+from cachetools import TTLCache
+from sqlglot import exp
+
+from config import (
+    TABLE_NAME,
+    MAX_ROWS,
+    MAX_LIST_ROWS,
+    MAX_COLS,
+    MAX_ROWS_FOR_LLM,
+    QUERY_WORKERS,
+    QUERY_RESULT_CACHE_TTL,
+    QUERY_RESULT_CACHE_MAXSIZE,
+)
+from db import db_json_tool
+from singleflight import SingleFlight
+
+# Nós que nunca podem aparecer numa consulta do agente (nem dentro de CTE/subquery)
+_FORBIDDEN_NODES = (
+    exp.Insert,
+    exp.Update,
+    exp.Delete,
+    exp.Merge,
+    exp.Create,
+    exp.Drop,
+    exp.Alter,
+    exp.Copy,
+    exp.Command,
+    exp.Into,  # SELECT ... INTO cria tabela
+    exp.Lock,  # SELECT ... FOR UPDATE/SHARE trava linhas (e o ETL)
+)
+
+# Única tabela que as consultas do agente podem ler (além das próprias CTEs)
+_ALLOWED_TABLES = {TABLE_NAME}
+_ALLOWED_SCHEMAS = {"", "public"}
+
+# Funções do servidor que leem arquivos, dormem, mexem em sessões/config etc.
+_FORBIDDEN_FUNC_PREFIXES = ("pg_", "lo_", "dblink", "set_config", "current_setting")
+# query_to_xml, table_to_xml, cursor_to_xml...: executam SQL arbitrária passada como texto
+_FORBIDDEN_FUNC_MARKERS = ("_to_xml",)
+
+# Resultado por SQL (já normalizada pelo sqlglot): perguntas repetidas
+# costumam gerar exatamente a mesma consulta.
+_result_cache: TTLCache = TTLCache(maxsize=QUERY_RESULT_CACHE_MAXSIZE, ttl=QUERY_RESULT_CACHE_TTL)
+_result_lock = threading.Lock()
+
+# A mesma SQL em execução ao mesmo tempo (repetida no plano, ou vinda de
+# perguntas diferentes) vai ao banco uma vez só; as outras esperam o resultado.
+_result_flight = SingleFlight()
+
+# Pool único para as subconsultas de todas as requisições: não cria threads por
+# pergunta e limita as consultas simultâneas ao que o pool de conexões comporta.
+_query_pool = ThreadPoolExecutor(max_workers=QUERY_WORKERS, thread_name_prefix="agent-query")
+
+
+@lru_cache(maxsize=512)
+def _parse_select(sql: str) -> exp.Query | None:
+    """
+    Faz o parse (uma vez por SQL) e devolve a árvore se for exatamente
+    um SELECT/UNION sem comandos de escrita, lendo só a tabela permitida e
+    sem funções administrativas do Postgres; senão None.
+    """
+    try:
+        statements = sqlglot.parse(sql, read="postgres")
+    except sqlglot.errors.ParseError:
+        return None
+
+    statements = [st for st in statements if st is not None]
+    if len(statements) != 1:
+        return None
+
+    tree = statements[0]
+    if not isinstance(tree, exp.Query):
+        return None
+    if tree.find(*_FORBIDDEN_NODES) is not None:
+        return None
+
+    ctes = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+    for table in tree.find_all(exp.Table):
+        if table.name in ctes and not table.db:
+            continue
+        if table.name not in _ALLOWED_TABLES or table.db not in _ALLOWED_SCHEMAS or table.catalog:
+            return None
+
+    for func in tree.find_all(exp.Anonymous):
+        name = func.name.lower()
+        if name.startswith(_FORBIDDEN_FUNC_PREFIXES) or any(m in name for m in _FORBIDDEN_FUNC_MARKERS):
+            return None
+    return tree
 
 
 def is_safe_sql(sql: str) -> bool:
-    return sql.strip().lower().startswith("select")
+    return _parse_select(sql) is not None
 
 
+@lru_cache(maxsize=512)
 def enforce_sql_limits(sql: str) -> str:
-    sql_clean = sql.strip().rstrip(";")
-    if "limit" in sql_clean.lower():
-        return sql_clean + ";"
-    return sql_clean + f" LIMIT {MAX_ROWS};"
-
-
-def run_queries(queries: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    results: List[Dict[str, Any]] = []
-
-    for q in queries:
-        sql = enforce_sql_limits(q["sql"])
-        if not is_safe_sql(sql):
-            results.append({
-                **q,
-                "rows": [],
-                "error": "SQL insegura (não começa com SELECT)."
-            })
-            continue
+    """
+    Garante LIMIT <= MAX_ROWS no nível da AST: injeta quando falta e reduz
+    quando o LLM pede mais (ou usa LIMIT ALL / expressão). Listagens sem
+    LIMIT ganham o limite menor MAX_LIST_ROWS. FETCH FIRST n ROWS vale como
+    LIMIT n (sem n, é uma linha só).
+    """
+    tree = _parse_select(sql)
+    if tree is None:
+        return sql
+    limit = tree.args.get("limit")
+    if isinstance(limit, exp.Fetch):
+        value = limit.args.get("count") or exp.Literal.number(1)
+    else:
+        value = limit.expression if limit is not None else None
+    if limit is None:
+        tree = tree.limit(MAX_ROWS if _is_aggregate(tree) else MAX_LIST_ROWS)
+    elif not value.is_int or int(value.name) > MAX_ROWS:
+        tree = tree.limit(MAX_ROWS)
+    # Sem comentários: o que vai ao banco é exatamente o que foi validado
+    return tree.sql(dialect="postgres", comments=False)
+
+
+def _is_aggregate(tree: exp.Query) -> bool:
+    """SELECT com GROUP BY/DISTINCT ou funções de agregação (o resultado já é resumido)."""
+    if not isinstance(tree, exp.Select):
+        return True  # UNION etc.: mantém o limite geral
+    return bool(tree.args.get("group") or tree.args.get("distinct") or tree.find(exp.AggFunc))
+
+
+def count_columns(sql: str) -> int | None:
+    """Quantidade de colunas projetadas pela SELECT (None se usar *)."""
+    tree = _parse_select(sql)
+    if tree is None:
+        return None
+    selects = tree.selects
+    for e in selects:
+        if isinstance(e, exp.Star) or (isinstance(e, exp.Column) and isinstance(e.this, exp.Star)):
+            return None
+    return len(selects)
+
+
+def _sql_key(sql: str) -> str:
+    # sql já sai de enforce_sql_limits, regerada pelo sqlglot: espaços e
+    # maiúsculas são canônicos, não precisa normalizar de novo
+    return hashlib.blake2b(sql.encode(), digest_size=16).hexdigest()
+
+
+def _cached_rows(sql: str) -> Tuple[int, bool, str]:
+    key = _sql_key(sql)
+    with _result_lock:
+        cached = _result_cache.get(key)
+    if cached is not None:
+        return cached
+    return _result_flight.do(key, lambda: _fetch_rows(key, sql))
+
+
+def clear_result_cache() -> None:
+    with _result_lock:
+        _result_cache.clear()
+
+
+def _fetch_rows(key: str, sql: str) -> Tuple[int, bool, str]:
+    rows = db_json_tool(sql, MAX_ROWS_FOR_LLM)
+    with _result_lock:
+        _result_cache[key] = rows
+    return rows
+
+
+def _run_one(q: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Executa uma subconsulta. As linhas voltam já em JSON (montado pelo
+    Postgres) em "rows_json", cortadas em MAX_ROWS_FOR_LLM ("truncated"
+    indica que havia mais); "row_count" é quantas linhas vieram.
+    q não é alterada (pode ser a mesma guardada no cache de planos): o
+    resultado é um dict novo, montado uma vez.
+    """
+    if not is_safe_sql(q["sql"]):
+        return {
+            **q,
+            "row_count": 0,
+            "truncated": False,
+            "rows_json": "[]",
+            "error": f"SQL insegura (apenas um único SELECT sobre {TABLE_NAME} é permitido)."
+        }
+
+    # Colunas contadas na AST, antes de ir ao banco
+    n_cols = count_columns(q["sql"])
+    if n_cols is not None and n_cols > MAX_COLS:
+        return {
+            **q,
+            "row_count": 0,
+            "truncated": False,
+            "rows_json": "[]",
+            "error": f"SQL retornou muitas colunas ({n_cols})."
+        }
+
+    sql = enforce_sql_limits(q["sql"])
+
+    try:
+        row_count, truncated, rows_json = _cached_rows(sql)
+        return {
+            **q,
+            "row_count": row_count,
+            "truncated": truncated,
+            "rows_json": rows_json,
+            "error": None
+        }
+    except Exception as e:
+        return {
+            **q,
+            "row_count": 0,
+            "truncated": False,
+            "rows_json": "[]",
+            "error": f"Erro ao executar SQL: {e}"
+        }
+
+
+def start_query(q: Dict[str, Any]) -> Future:
+    """Dispara uma subconsulta no pool sem esperar (ex.: enquanto o plano ainda chega do LLM)."""
+    return _query_pool.submit(_run_one, q)
+
+
+def run_queries(
+    queries: List[Dict[str, Any]],
+    started: Sequence[Future] = (),
+) -> List[Dict[str, Any]]:
+    """
+    Executa as subconsultas em paralelo (são independentes entre si).
+    O driver do Postgres libera o GIL durante o I/O, então threads bastam.
+    A ordem dos resultados segue a ordem das queries; _run_one nunca levanta,
+    então a falha de uma subconsulta vira "error" sem derrubar as demais.
+
+    started traz as primeiras queries já disparadas com start_query (mesma
+    ordem); só as restantes são executadas aqui.
+    """
+    pending = queries[len(started):]
+    if not started and len(pending) <= 1:
+        return [_run_one(q) for q in pending]
 
-        try:
-            rows = db_mcp_tool(sql)
-            if rows and len(rows[0]) > MAX_COLS:
-                results.append({
-                    **q,
-                    "rows": [],
-                    "error": f"SQL retornou muitas colunas ({len(rows[0])})."
-                })
-                continue
-
-            results.append({
-                **q,
-                "rows": rows,
-                "error": None
-            })
-        except Exception as e:
-            results.append({
-                **q,
-                "rows": [],
-                "error": f"Erro ao executar SQL: {e}"
-            })
-
-    return results
+    futures = list(started) + [_query_pool.submit(_run_one, q) for q in pending]
+    return [f.result() for f in futures]
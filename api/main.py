@@ -2,11 +2,27 @@ import os
 
 import httpx
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
 AGENT_URL = os.getenv("AGENT_URL", "http://agent:9000/run-agent")
+AGENT_STREAM_URL = os.getenv("AGENT_STREAM_URL", AGENT_URL.rstrip("/") + "/stream")
 
-app = FastAPI(title="WeBox Faturamento API")
+app = FastAPI(title="WeBox Faturamento API", default_response_class=ORJSONResponse)
+
+# Cliente único para o agent-service: mantém as conexões abertas (keep-alive)
+# em vez de abrir um socket novo a cada pergunta. Assíncrono: a API só espera
+# o agent, então uma pergunta em andamento não ocupa uma thread do threadpool
+# (40 por padrão) durante toda a análise.
+AGENT_TIMEOUT = float(os.getenv("AGENT_TIMEOUT", "200"))
+agent_client = httpx.AsyncClient(
+    timeout=AGENT_TIMEOUT,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+
+
+# Proxies (nginx etc.) não devem segurar os eventos em buffer nem cachear o stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
 
 
 class AskRequest(BaseModel):
@@ -18,23 +34,28 @@ class AskResponse(BaseModel):
     debug_sql: str | None = None
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await agent_client.aclose()
+
+
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
 
 @app.post("/ask", response_model=AskResponse)
-def ask(req: AskRequest):
+async def ask(req: AskRequest):
     """
     API fina: só repassa a pergunta para o agent-service.
     O agent-service é quem decide SQL, consulta o banco e monta a resposta.
+    O corpo dele já está no formato de AskResponse e é repassado como veio.
     """
     try:
-        with httpx.Client(timeout=200.0) as client:
-            resp = client.post(
-                AGENT_URL,
-                json=req.model_dump(),
-            )
+        resp = await agent_client.post(
+            AGENT_URL,
+            json=req.model_dump(),
+        )
     except Exception as e:
         raise HTTPException(
             status_code=502,
@@ -47,8 +68,40 @@ def ask(req: AskRequest):
             detail=f"Agent-service retornou erro: {resp.text}",
         )
 
-    data = resp.json()
-    return AskResponse(
-        answer=data.get("answer", ""),
-        debug_sql=data.get("debug_sql"),
-    )
+    return Response(content=resp.content, media_type="application/json")
+
+
+@app.post("/ask/stream")
+async def ask_stream(req: AskRequest):
+    """
+    Versão em streaming do /ask: repassa os eventos SSE do agent-service
+    assim que chegam ("debug_sql", pedaços da resposta, "error" se a
+    geração falhar no meio e "done").
+    """
+    try:
+        resp = await agent_client.send(
+            agent_client.build_request("POST", AGENT_STREAM_URL, json=req.model_dump()),
+            stream=True,
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Erro ao chamar agent-service: {e}",
+        )
+
+    if resp.status_code != 200:
+        await resp.aread()
+        await resp.aclose()
+        raise HTTPException(
+            status_code=resp.status_code,
+            detail=f"Agent-service retornou erro: {resp.text}",
+        )
+
+    async def relay():
+        try:
+            async for chunk in resp.aiter_raw():
+                yield chunk
+        finally:
+            await resp.aclose()
+
+    return StreamingResponse(relay(), media_type="text/event-stream", headers=SSE_HEADERS)
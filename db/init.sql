@@ -8,6 +8,21 @@ CREATE TABLE faturamento (
     created_at TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
+-- Filtro por cliente é frequente nas consultas geradas pelo agente.
+-- (Colunas de data ganham índice pelo ETL quando são criadas.)
+CREATE INDEX IF NOT EXISTS idx_faturamento_cliente_id ON faturamento (cliente_id);
+
+-- Planos de consulta já gerados pelo LLM, com o embedding da pergunta.
+-- O agente os recarrega no cache semântico ao subir (vale por esquema).
+CREATE TABLE IF NOT EXISTS query_templates (
+    schema_fingerprint TEXT NOT NULL,
+    question TEXT NOT NULL,            -- pergunta normalizada
+    embedding BYTEA NOT NULL,          -- float32, norma 1
+    queries JSONB NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (schema_fingerprint, question)
+);
+
 -- Histórico dos jobs de ETL
 CREATE TABLE IF NOT EXISTS etl_jobs (
     id SERIAL PRIMARY KEY,
@@ -19,3 +34,9 @@ CREATE TABLE IF NOT EXISTS etl_jobs (
     finished_at TIMESTAMP WITHOUT TIME ZONE,
     error_message TEXT
 );
+
+-- O ETL lê os jobs de sucesso novos (id > último lido) a cada varredura:
+-- índice parcial só com os sucessos, coberto (index-only scan)
+CREATE INDEX IF NOT EXISTS idx_etl_jobs_success
+    ON etl_jobs (id) INCLUDE (arquivo_nome)
+    WHERE status = 'success';
@@ -15,8 +15,25 @@ INBOX_DIR = Path(os.getenv("INBOX_DIR", "/data/inbox"))
 # Cliente padrão (fallback) caso não consiga extrair do nome do arquivo
 CLIENTE_ID_DEFAULT = os.getenv("CLIENTE_ID", "cliente_demo")
 
-# Intervalo entre varreduras (segundos)
+# Intervalo entre varreduras (segundos). Com os eventos de arquivo (inotify)
+# um .xlsx novo já dispara a varredura; o intervalo é a rede de segurança
+# (eventos perdidos, volumes de rede sem inotify).
 POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "30"))
 
+# Arquivos processados em paralelo numa varredura (leitura do Excel de um
+# enquanto outro está no COPY); cada um usa uma conexão própria
+ETL_WORKERS = int(os.getenv("ETL_WORKERS", "4"))
+
+# ALTER TABLE de colunas novas: espera no máximo DDL_LOCK_TIMEOUT_MS pelo lock
+# da tabela (o COPY de outro worker o segura até o COMMIT) e tenta de novo até
+# DDL_LOCK_RETRIES vezes. Na fila do lock, o ALTER bloquearia também as
+# SELECTs do agente; entre as tentativas elas passam.
+DDL_LOCK_TIMEOUT_MS = int(os.getenv("DDL_LOCK_TIMEOUT_MS", "2000"))
+DDL_LOCK_RETRIES = int(os.getenv("DDL_LOCK_RETRIES", "60"))
+
+# Por quanto tempo (segundos) as colunas conhecidas da tabela valem sem
+# consultar o banco de novo (o próprio ETL atualiza o cache quando cria colunas)
+COLUMNS_CACHE_TTL = int(os.getenv("COLUMNS_CACHE_TTL", "60"))
+
 # Colunas reservadas da tabela (metadados internos)
 RESERVED_COLS = {"id", "cliente_id", "arquivo_nome", "linha_numero", "created_at"}
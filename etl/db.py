@@ -1,42 +1,97 @@
+import time
 from typing import List, Dict
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, make_url, text
 
-from config import DATABASE_URL, TABLE_NAME
+from config import DATABASE_URL, TABLE_NAME, COLUMNS_CACHE_TTL, ETL_WORKERS
 
-# Engine global
-engine = create_engine(DATABASE_URL)
+# Driver psycopg 3 (o mesmo do agent-service): COPY em streaming pelo cursor.
+# Aceita DATABASE_URL no formato postgresql:// e só troca o driver.
+ENGINE_URL = make_url(DATABASE_URL).set(drivername="postgresql+psycopg")
+
+# Engine global. Uma conexão por worker (mais a da varredura), paradas entre
+# as varreduras (POLL_INTERVAL): pre_ping/recycle evitam pegar do pool uma
+# conexão que o servidor (ou um proxy) já derrubou.
+engine = create_engine(
+    ENGINE_URL,
+    pool_size=ETL_WORKERS + 1,
+    max_overflow=0,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    # Identifica as conexões do ETL em pg_stat_activity
+    connect_args={"application_name": "etl_watcher"},
+)
+
+
+# Arquivos já processados com sucesso e o maior etl_jobs.id já lido: a cada
+# varredura só os jobs novos vêm do banco. Os workers de uma varredura podem
+# fazer COMMIT dos jobs fora da ordem dos ids, mas a leitura só acontece
+# depois que a varredura anterior inteira terminou (main espera o pool.map):
+# nenhum id menor que o último lido ainda pode estar para entrar.
+_processados: set[str] = set()
+_last_job_id = 0
+
+_PROCESSADOS_SQL = text(
+    """
+    SELECT id, arquivo_nome
+    FROM etl_jobs
+    WHERE status = 'success'
+      AND id > :last_id
+    ORDER BY id
+    """
+)
 
 
 def get_processados() -> set[str]:
     """
     Busca no banco os arquivos já processados com sucesso (qualquer cliente).
     Assim evitamos processar o mesmo arquivo várias vezes.
+    O conjunto devolvido é o cache do módulo: só para leitura.
     """
-    sql = text(
-        """
-        SELECT DISTINCT arquivo_nome
-        FROM etl_jobs
-        WHERE status = 'success'
-        """
-    )
+    global _last_job_id
     with engine.begin() as conn:
-        result = conn.execute(sql)
-        nomes = {row[0] for row in result.fetchall()}
-    return nomes
+        result = conn.execute(_PROCESSADOS_SQL, {"last_id": _last_job_id})
+        for job_id, arquivo_nome in result:
+            _processados.add(arquivo_nome)
+            _last_job_id = job_id
+    return _processados
+
+
+_COLUMNS_SQL = text(
+    """
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name = :table
+    """
+)
 
+# tabela -> (colunas, instante em que foram lidas, em time.monotonic())
+_columns_cache: Dict[str, tuple[set[str], float]] = {}
 
-def get_existing_columns(table_name: str = TABLE_NAME) -> set[str]:
+
+def get_existing_columns(table_name: str = TABLE_NAME, conn=None) -> set[str]:
     """
     Busca as colunas já existentes na tabela de faturamento.
+    Cacheado por COLUMNS_CACHE_TTL: vários arquivos na mesma varredura
+    não repetem a consulta. Com conn, a consulta usa essa conexão (o worker
+    já tem a sua; pegar outra do pool disputaria com os demais arquivos).
     """
-    sql = text(
-        """
-        SELECT column_name
-        FROM information_schema.columns
-        WHERE table_name = :table
-        """
-    )
-    with engine.begin() as conn:
-        result = conn.execute(sql, {"table": table_name})
-        return {row[0] for row in result.fetchall()}
+    cached = _columns_cache.get(table_name)
+    if cached is not None and time.monotonic() - cached[1] < COLUMNS_CACHE_TTL:
+        return set(cached[0])
+
+    if conn is None:
+        with engine.begin() as conn:
+            columns = {row[0] for row in conn.execute(_COLUMNS_SQL, {"table": table_name})}
+    else:
+        columns = {row[0] for row in conn.execute(_COLUMNS_SQL, {"table": table_name})}
+
+    _columns_cache[table_name] = (columns, time.monotonic())
+    return set(columns)
+
+
+def add_known_columns(table_name: str, columns: List[str]) -> None:
+    """Registra no cache colunas que o próprio ETL acabou de criar (após o COMMIT)."""
+    cached = _columns_cache.get(table_name)
+    if cached is not None:
+        _columns_cache[table_name] = (cached[0] | set(columns), cached[1])
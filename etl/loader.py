@@ -1,12 +1,20 @@
+import csv
+import io
+import time
 from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import chain, islice
 from pathlib import Path
-from typing import Dict
+from typing import Iterator
 
 import pandas as pd
+from psycopg.errors import LockNotAvailable
+from python_calamine import CalamineWorkbook
 from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 
-from config import TABLE_NAME
-from db import engine, get_existing_columns
+from config import DDL_LOCK_RETRIES, DDL_LOCK_TIMEOUT_MS, TABLE_NAME
+from db import engine, get_existing_columns, add_known_columns
 from transform import (
     normalize_columns,
     rename_reserved_columns,
@@ -14,6 +22,40 @@ from transform import (
 )
 
 
+# Linhas da planilha lidas (e enviadas ao COPY) por bloco: a memória do
+# processamento fica limitada ao bloco, não ao tamanho do arquivo
+COPY_CHUNK_ROWS = 50_000
+
+# SQLs fixas montadas uma vez só (text() a cada arquivo refaz o parse dos binds)
+_NOTIFY_SQL = text("SELECT pg_notify('schema_changed', :table)")
+_LOCK_TIMEOUT_SQL = text(f"SET LOCAL lock_timeout = {DDL_LOCK_TIMEOUT_MS}")
+# Linhas novas: o agent-service descarta as respostas em cache da tabela
+_DATA_NOTIFY_SQL = text("SELECT pg_notify('data_changed', :table)")
+
+_INSERT_JOB_SQL = text(
+    """
+    INSERT INTO etl_jobs (
+        arquivo_nome,
+        cliente_id,
+        status,
+        rows_imported,
+        started_at,
+        finished_at,
+        error_message
+    )
+    VALUES (
+        :arquivo_nome,
+        :cliente_id,
+        :status,
+        :rows_imported,
+        :started_at,
+        :finished_at,
+        :error_message
+    )
+    """
+)
+
+
 def extract_cliente_id(file_path: Path, default_cliente_id: str) -> str:
     """
     Extrai o cliente_id do nome do arquivo.
@@ -33,12 +75,73 @@ def extract_cliente_id(file_path: Path, default_cliente_id: str) -> str:
     return default_cliente_id
 
 
-def ensure_columns_exist(df: pd.DataFrame, table_name: str = TABLE_NAME):
+def _cell(value):
+    """Converte uma célula do calamine como o pd.read_excel faria."""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if value == "":
+        return None
+    return value
+
+
+def _header(cells: list) -> list[str]:
+    """Nomes das colunas como o pandas monta: vazio vira "Unnamed: i", repetido ganha ".1", ".2"..."""
+    names: list[str] = []
+    seen: dict[str, int] = {}
+    for i, value in enumerate(cells):
+        name = f"Unnamed: {i}" if value is None else str(value)
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        names.append(f"{name}.{count}" if count else name)
+    return names
+
+
+def column_names(header: list) -> list[str]:
+    """Nomes finais das colunas da planilha: normalizados e com as reservadas renomeadas."""
+    df = pd.DataFrame(columns=_header(header))
+    return list(rename_reserved_columns(normalize_columns(df)).columns)
+
+
+def read_sheet_rows(file_path: Path) -> Iterator[list]:
+    """
+    Linhas da primeira planilha do arquivo, uma a uma e já convertidas. Como no
+    pd.read_excel, linhas em branco ficam de fora: a primeira que sobra é o
+    cabeçalho.
+    """
+    sheet = CalamineWorkbook.from_path(str(file_path)).get_sheet_by_index(0)
+    for row in sheet.iter_rows():
+        cells = [_cell(v) for v in row]
+        if any(v is not None for v in cells):
+            yield cells
+
+
+def create_missing_columns(conn, df: pd.DataFrame, table_name: str = TABLE_NAME):
+    """
+    ensure_columns_exist numa transação própria com lock_timeout: se outro
+    worker está no COPY, desiste do lock, libera a fila (as consultas do agente
+    não ficam presas atrás do ALTER) e tenta de novo. Cada tentativa relê as
+    colunas existentes; outro arquivo pode tê-las criado nesse meio tempo.
+    """
+    for attempt in range(1, DDL_LOCK_RETRIES + 1):
+        try:
+            with conn.begin():
+                conn.execute(_LOCK_TIMEOUT_SQL)
+                return ensure_columns_exist(conn, df, table_name=table_name)
+        except OperationalError as e:
+            if not isinstance(e.orig, LockNotAvailable) or attempt == DDL_LOCK_RETRIES:
+                raise
+            print(f"[ETL] Tabela {table_name} ocupada por outra carga; nova tentativa ({attempt}/{DDL_LOCK_RETRIES})")
+            time.sleep(DDL_LOCK_TIMEOUT_MS / 1000)
+
+
+def ensure_columns_exist(conn, df: pd.DataFrame, table_name: str = TABLE_NAME):
     """
     Garante que todas as colunas do DataFrame existam na tabela.
-    Faz ALTER TABLE ADD COLUMN se faltar alguma.
+    Faz ALTER TABLE ADD COLUMN se faltar alguma, na transação de conn, que
+    deve ser curta e só com o DDL: o ALTER trava a tabela (ACCESS EXCLUSIVE)
+    até o COMMIT. Devolve as colunas criadas.
     """
-    existing = get_existing_columns(table_name)
+    existing = get_existing_columns(table_name, conn)
 
     # TODAS as colunas vindas do Excel (já normalizadas e com reservadas renomeadas)
     excel_cols = list(df.columns)
@@ -46,16 +149,73 @@ def ensure_columns_exist(df: pd.DataFrame, table_name: str = TABLE_NAME):
 
     if not novas:
         print("[ETL] Nenhuma coluna nova para criar.")
-        return
+        return []
 
     print(f"[ETL] Criando {len(novas)} coluna(s) nova(s) na tabela {table_name}: {novas}")
 
-    with engine.begin() as conn:
-        for col in novas:
-            col_type = infer_column_type(df[col])
-            alter_sql = text(f'ALTER TABLE {table_name} ADD COLUMN "{col}" {col_type};')
-            print(f"[ETL] ALTER TABLE: adicionando coluna {col} ({col_type})")
-            conn.execute(alter_sql)
+    col_types = {col: infer_column_type(df[col]) for col in novas}
+    for col, col_type in col_types.items():
+        print(f"[ETL] ALTER TABLE: adicionando coluna {col} ({col_type})")
+
+    # Um único ALTER com todas as colunas: um lock da tabela e uma ida ao banco.
+    # IF NOT EXISTS: outro arquivo da mesma varredura pode ter criado a coluna
+    # depois que as colunas existentes foram lidas.
+    clauses = ", ".join(
+        f'ADD COLUMN IF NOT EXISTS "{col}" {col_type}' for col, col_type in col_types.items()
+    )
+    conn.execute(text(f"ALTER TABLE {table_name} {clauses};"))
+
+    # Colunas de data são o filtro mais comum das consultas geradas pelo
+    # agente (intervalos de período): índice já na criação da coluna.
+    for col, col_type in col_types.items():
+        if col_type == "DATE":
+            index_sql = text(
+                f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_{col}" ON {table_name} ("{col}");'
+            )
+            print(f"[ETL] Criando índice para a coluna de data {col}")
+            conn.execute(index_sql)
+
+    # Avisa o agent-service (LISTEN schema_changed) para recarregar o esquema.
+    # A notificação só é entregue no COMMIT, junto com as colunas novas.
+    conn.execute(_NOTIFY_SQL, {"table": table_name})
+    return novas
+
+
+def copy_rows(
+    conn, rows: Iterator[list], table_name: str, columns: list[str], cliente_id: str, arquivo_nome: str
+) -> int:
+    """
+    Carrega as linhas com um único COPY ... FROM STDIN (CSV), em vez de um
+    INSERT (e uma ida ao banco) por linha. As células já convertidas por
+    _cell viram CSV (com as colunas fixas na frente; None vira NULL) e vão
+    para o COPY em blocos de COPY_CHUNK_ROWS: nem a planilha nem o CSV ficam
+    inteiros em memória. Devolve o total de linhas copiadas.
+
+    É o único caminho de escrita, tenha o arquivo colunas novas ou não: a
+    mesma planilha sempre chega ao banco com os mesmos valores.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    total = 0
+    # COPY é do driver (psycopg 3): usa a conexão crua, dentro da mesma transação
+    with conn.connection.driver_connection.cursor() as cur:
+        with cur.copy(_copy_sql(table_name, tuple(columns))) as copy:
+            while batch := list(islice(rows, COPY_CHUNK_ROWS)):
+                writer.writerows(
+                    [cliente_id, arquivo_nome, total + i, *row] for i, row in enumerate(batch, start=1)
+                )
+                total += len(batch)
+                copy.write(buf.getvalue())
+                buf.seek(0)
+                buf.truncate()
+    return total
+
+
+# Arquivos do mesmo cliente costumam ter as mesmas colunas: mesmo comando
+@lru_cache(maxsize=64)
+def _copy_sql(table_name: str, columns: tuple[str, ...]) -> str:
+    columns_sql = ", ".join(f'"{c}"' for c in columns)
+    return f"COPY {table_name} ({columns_sql}) FROM STDIN WITH (FORMAT csv)"
 
 
 def run_etl_for_file(file_path: Path, cliente_id: str, table_name: str = TABLE_NAME):
@@ -69,104 +229,84 @@ def run_etl_for_file(file_path: Path, cliente_id: str, table_name: str = TABLE_N
     """
     started_at = datetime.now(timezone.utc)
     arquivo_nome = file_path.name
-    status_job = "success"
-    rows_imported = 0
-    error_message: str | None = None
+    job = {
+        "arquivo_nome": arquivo_nome,
+        "cliente_id": cliente_id,
+        "started_at": started_at,
+    }
 
     print(f"[ETL] Iniciando processamento de {arquivo_nome} para cliente {cliente_id}")
 
-    try:
-        # 1) Lê o Excel e normaliza colunas
-        df = pd.read_excel(file_path)
-        df = normalize_columns(df)
-        df = rename_reserved_columns(df)
+    # Uma conexão do pool para o arquivo inteiro (carga e registro do job)
+    with engine.connect() as conn:
+        try:
+            # 1) Lê o Excel linha a linha (calamine: parser em Rust, bem mais
+            #    rápido que o openpyxl) e normaliza o cabeçalho
+            rows = read_sheet_rows(file_path)
+            header = next(rows, None)
+            if header is None:
+                raise ValueError("Planilha sem linhas de dados.")
+            columns = column_names(header)
+            copy_columns = ["cliente_id", "arquivo_nome", "linha_numero", *columns]
 
-        if df.empty:
-            raise ValueError("Planilha sem linhas de dados.")
+            # 2) Colunas do Excel que faltam na tabela (tipos inferidos pelo
+            #    primeiro bloco): DDL, índices e pg_notify numa transação curta
+            #    e própria. O ALTER TABLE trava a tabela até o COMMIT; junto da
+            #    carga, as consultas do agente e os outros workers esperariam
+            #    o COPY do arquivo inteiro. Com lock_timeout e novas tentativas,
+            #    o ALTER também não fica na fila atrás do COPY de outro worker.
+            with conn.begin():
+                existing = get_existing_columns(table_name, conn)
 
-        # 2) Garante que as colunas do Excel existam na tabela (DDL dinâmico)
-        ensure_columns_exist(df, table_name=table_name)
+            if not set(columns) <= existing:
+                # O DataFrame do primeiro bloco só serve para inferir os tipos:
+                # as linhas em si vão para o COPY como no caminho sem colunas novas
+                first_rows = list(islice(rows, COPY_CHUNK_ROWS))
+                if first_rows:
+                    first = pd.DataFrame(first_rows, columns=columns)
+                    novas = create_missing_columns(conn, first, table_name=table_name)
+                    add_known_columns(table_name, novas)
+                rows = chain(first_rows, rows)
 
-        # 3) Prepara INSERT com todas as colunas: fixas + do Excel
-        excel_cols = list(df.columns)
-        all_cols = ["cliente_id", "arquivo_nome", "linha_numero"] + excel_cols
+            # 3) Transação da carga: só o COPY (todas as linhas, bloco a bloco) e
+            #    o job de sucesso em etl_jobs, sem DDL (nenhum lock exclusivo na
+            #    tabela enquanto o arquivo é copiado). Linhas e job entram juntos:
+            #    um arquivo carregado nunca fica sem registro (e não é
+            #    reprocessado na próxima varredura).
+            with conn.begin():
+                copied = copy_rows(conn, rows, table_name, copy_columns, cliente_id, arquivo_nome)
+                if not copied:
+                    raise ValueError("Planilha sem linhas de dados.")
+                # Entregue só no COMMIT, quando as linhas já estão visíveis
+                conn.execute(_DATA_NOTIFY_SQL, {"table": table_name})
+                conn.execute(
+                    _INSERT_JOB_SQL,
+                    {
+                        **job,
+                        "status": "success",
+                        "rows_imported": copied,
+                        "finished_at": datetime.now(timezone.utc),
+                        "error_message": None,
+                    },
+                )
 
-        columns_sql = ", ".join(f'"{c}"' for c in all_cols)
-        values_sql = ", ".join(f":{c}" for c in all_cols)
+            print(f"[ETL] Inseridas {copied} linhas em {table_name}.")
+            print(f"[ETL] Job registrado com sucesso em etl_jobs.")
 
-        insert_sql = text(
-            f"""
-            INSERT INTO {table_name} (
-                {columns_sql}
-            )
-            VALUES (
-                {values_sql}
-            )
-            """
-        )
-
-        # 4) Insere linha a linha
-        with engine.begin() as conn:
-            for idx, row in df.iterrows():
-                rec: Dict[str, object] = {
-                    "cliente_id": cliente_id,
-                    "arquivo_nome": arquivo_nome,
-                    "linha_numero": idx + 1,
-                }
-
-                for col in excel_cols:
-                    rec[col] = row.get(col)
-
-                conn.execute(insert_sql, rec)
-
-            rows_imported = len(df)
-            print(f"[ETL] Inseridas {rows_imported} linhas em {table_name}.")
-
-    except Exception as e:
-        status_job = "fail"
-        error_message = str(e)
-        print(f"[ETL] Erro ao processar {arquivo_nome}: {error_message}")
-
-    finally:
-        finished_at = datetime.now(timezone.utc)
-
-        # 5) Registra job em etl_jobs
-        with engine.begin() as conn:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO etl_jobs (
-                        arquivo_nome,
-                        cliente_id,
-                        status,
-                        rows_imported,
-                        started_at,
-                        finished_at,
-                        error_message
-                    )
-                    VALUES (
-                        :arquivo_nome,
-                        :cliente_id,
-                        :status,
-                        :rows_imported,
-                        :started_at,
-                        :finished_at,
-                        :error_message
-                    )
-                    """
-                ),
-                {
-                    "arquivo_nome": arquivo_nome,
-                    "cliente_id": cliente_id,
-                    "status": status_job,
-                    "rows_imported": rows_imported,
-                    "started_at": started_at,
-                    "finished_at": finished_at,
-                    "error_message": error_message,
-                },
-            )
+        except Exception as e:
+            error_message = str(e)
+            print(f"[ETL] Erro ao processar {arquivo_nome}: {error_message}")
 
-        if status_job == "success":
-            print(f"[ETL] Job registrado com sucesso em etl_jobs.")
-        else:
+            # 4) Job com falha: transação própria, depois do ROLLBACK da carga
+            with conn.begin():
+                conn.execute(
+                    _INSERT_JOB_SQL,
+                    {
+                        **job,
+                        "status": "fail",
+                        "rows_imported": 0,
+                        "finished_at": datetime.now(timezone.utc),
+                        "error_message": error_message,
+                    },
+                )
             print(f"[ETL] Job com falha registrado em etl_jobs.")
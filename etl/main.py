@@ -1,11 +1,57 @@
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from config import INBOX_DIR, CLIENTE_ID_DEFAULT, POLL_INTERVAL, TABLE_NAME
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from config import INBOX_DIR, CLIENTE_ID_DEFAULT, POLL_INTERVAL, TABLE_NAME, ETL_WORKERS
 from db import get_processados
 from loader import run_etl_for_file, extract_cliente_id
 
 
+# Sinalizado quando um .xlsx termina de chegar na inbox: adianta a próxima varredura
+_wakeup = threading.Event()
+
+
+class _InboxHandler(FileSystemEventHandler):
+    """
+    Só arquivos completos: fechados depois de escritos (IN_CLOSE_WRITE) ou
+    movidos para a inbox. A criação dispararia com o arquivo ainda pela metade.
+    """
+
+    def on_closed(self, event):
+        if not event.is_directory and str(event.src_path).endswith(".xlsx"):
+            _wakeup.set()
+
+    def on_moved(self, event):
+        if not event.is_directory and str(event.dest_path).endswith(".xlsx"):
+            _wakeup.set()
+
+
+def start_inbox_observer(inbox_dir: Path) -> Observer | None:
+    """
+    Observa a inbox (inotify no Linux) para processar arquivos assim que chegam.
+    Se não der (limite de inotify, sistema de arquivos sem eventos), fica só a
+    varredura periódica, que de qualquer forma continua rodando.
+    """
+    observer = Observer()
+    try:
+        observer.schedule(_InboxHandler(), str(inbox_dir), recursive=False)
+        observer.start()
+    except OSError as e:
+        print(f"[ETL] Eventos de arquivo indisponíveis ({e}), seguindo só com a varredura.")
+        return None
+    print(f"[ETL] Observando eventos de arquivo em {inbox_dir}")
+    return observer
+
+
+def process_file(file: Path):
+    cliente_id = extract_cliente_id(file, CLIENTE_ID_DEFAULT)
+    print(f"[ETL] Arquivo {file.name} será processado para cliente {cliente_id}")
+    run_etl_for_file(file, cliente_id, table_name=TABLE_NAME)
+
+
 def main():
     inbox_dir: Path = INBOX_DIR
 
@@ -13,12 +59,20 @@ def main():
     print(f"[ETL] Cliente padrão (fallback): {CLIENTE_ID_DEFAULT}")
     print(f"[ETL] Intervalo de varredura: {POLL_INTERVAL} segundos")
     print(f"[ETL] Tabela de destino: {TABLE_NAME}")
+    print(f"[ETL] Arquivos em paralelo: {ETL_WORKERS}")
 
+    observer_started = False
     while True:
+        # Eventos que chegarem durante a varredura disparam a próxima na hora
+        _wakeup.clear()
         try:
             if not inbox_dir.exists():
                 print(f"[ETL] Diretório {inbox_dir} não existe, aguardando...")
             else:
+                if not observer_started:
+                    observer_started = True
+                    start_inbox_observer(inbox_dir)
+
                 todos_arquivos = list(inbox_dir.glob("*.xlsx"))
                 if not todos_arquivos:
                     print(f"[ETL] Nenhum .xlsx encontrado em {inbox_dir}")
@@ -31,16 +85,19 @@ def main():
                 else:
                     print("[ETL] Nenhum arquivo novo para processar.")
 
-                for file in novos:
-                    cliente_id = extract_cliente_id(file, CLIENTE_ID_DEFAULT)
-                    print(f"[ETL] Arquivo {file.name} será processado para cliente {cliente_id}")
-                    run_etl_for_file(file, cliente_id, table_name=TABLE_NAME)
+                # Arquivos independentes: leitura (calamine) e COPY liberam o GIL.
+                # O pool.map também é a barreira que a marca d'água de
+                # get_processados exige: todos os jobs desta varredura terminam
+                # antes da próxima leitura.
+                with ThreadPoolExecutor(max_workers=ETL_WORKERS, thread_name_prefix="etl") as pool:
+                    list(pool.map(process_file, novos))
 
         except Exception as e:
             print(f"[ETL] Erro inesperado no loop principal: {e}")
 
-        print(f"[ETL] Aguardando {POLL_INTERVAL} segundos para nova varredura...")
-        time.sleep(POLL_INTERVAL)
+        print(f"[ETL] Aguardando {POLL_INTERVAL} segundos (ou um arquivo novo) para nova varredura...")
+        if _wakeup.wait(POLL_INTERVAL):
+            print("[ETL] Arquivo novo na inbox.")
 
 
 if __name__ == "__main__":
@@ -1,3 +1,6 @@
+import re
+import unicodedata
+
 import pandas as pd
 from pandas.api.types import (
     is_datetime64_any_dtype,
@@ -7,19 +10,28 @@ from pandas.api.types import (
 
 from config import RESERVED_COLS
 
+_NON_ALNUM_RE = re.compile(r"[^0-9a-zA-Z]+")
+# Nome que a normalização devolveria sem mudar nada
+_SNAKE_RE = re.compile(r"[a-z0-9_]+")
+
+# Valores não nulos usados para testar data/número numa coluna de texto
+INFER_SAMPLE_SIZE = 1000
+
+
+def _normalize_column_name(name) -> str:
+    name = unicodedata.normalize("NFKD", str(name).strip().lower())
+    return _NON_ALNUM_RE.sub("_", name.encode("ascii", errors="ignore").decode("ascii"))
+
 
 def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Normaliza nomes de colunas para snake_case, sem acentos."""
-    df = df.copy()
-    df.columns = (
-        df.columns
-        .str.strip()
-        .str.lower()
-        .str.normalize("NFKD")
-        .str.encode("ascii", errors="ignore")
-        .str.decode("ascii")
-        .str.replace(r"[^0-9a-zA-Z]+", "_", regex=True)
-    )
+    # Planilhas de um mesmo modelo costumam já vir com cabeçalho normalizado
+    if all(isinstance(c, str) and _SNAKE_RE.fullmatch(c) for c in df.columns):
+        return df
+
+    # Cópia rasa: só os rótulos das colunas mudam, os dados são os mesmos
+    df = df.copy(deep=False)
+    df.columns = [_normalize_column_name(c) for c in df.columns]
     return df
 
 
@@ -29,7 +41,6 @@ def rename_reserved_columns(df: pd.DataFrame) -> pd.DataFrame:
     renomeia essas colunas para evitar conflito com os metadados da tabela.
     Exemplo: cliente_id -> cliente_id_excel
     """
-    df = df.copy()
     renames = {}
 
     for col in df.columns:
@@ -44,7 +55,9 @@ def rename_reserved_columns(df: pd.DataFrame) -> pd.DataFrame:
 
     if renames:
         print(f"[ETL] Renomeando colunas reservadas da planilha: {renames}")
-        df = df.rename(columns=renames)
+        # Cópia rasa + rótulos novos: df.rename copiaria todos os dados
+        df = df.copy(deep=False)
+        df.columns = [renames.get(c, c) for c in df.columns]
 
     return df
 
@@ -72,7 +85,9 @@ def infer_column_type(series: pd.Series) -> str:
         return "NUMERIC"
 
     # 3) Para colunas de texto/objeto: tenta data, depois número
-    #    (e só se >90% dos valores forem válidos)
+    #    (e só se >90% dos valores forem válidos). Basta uma amostra: as
+    #    primeiras INFER_SAMPLE_SIZE linhas, em vez de converter a coluna toda.
+    s = s.iloc[:INFER_SAMPLE_SIZE]
     try:
         s_dt = pd.to_datetime(s, errors="coerce", dayfirst=True)
         if s_dt.notna().mean() > 0.9: